@@ -0,0 +1,129 @@
+""" Batch rendering of turtle graphics command files
+
+Renders every file matching a glob to an image on the Agg canvas, without Tkinter.
+The files are spread over a pool of processes, each of which keeps one figure and reuses it for all its files.
+A summary with the time and error of every file is printed and written as JSON.
+
+Usage:
+python batch_render.py "scripts/**/*.txt" -d images --variant 2d -j 8 -o summary.json
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+""" Global variables """
+modules_variant = {
+    "2d": "turtle_graphics",
+    "step_motion": "turtle_graphics_step_motion",
+    "3d": "turtle_graphics_3d",
+}
+
+""" Objects of a worker process """
+module = None
+artists_fixed = None
+
+""" Classes and functions """
+
+
+def init_worker(variant, cache_dir):
+    """ Import the turtle graphics module once per process, its figure is reused for every file """
+    global module, artists_fixed
+    module = importlib.import_module(modules_variant[variant])
+    module.trace.level = module.TRACE_OFF
+    if cache_dir:
+        module.program_cache.directory = cache_dir
+    artists_fixed = set(module.ax0.get_children())
+
+
+def clear_figure():
+    """ Remove the artists of the previous file, keeping those the module created with its axes """
+    for artist in module.ax0.get_children():
+        if artist not in artists_fixed:
+            artist.remove()
+
+
+def render_job(job):
+    """ Render one command file, return its summary instead of raising so one bad file does not stop the batch """
+    filename, output = job
+    time_start = time.perf_counter()
+    error = None
+    try:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        module.render_file(filename, output)
+    except Exception as e:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+    finally:
+        clear_figure()
+    return {
+        "file": filename,
+        "output": None if error else output,
+        "seconds": time.perf_counter() - time_start,
+        "error": error,
+        "pid": os.getpid(),
+    }
+
+
+def make_jobs(filenames, output_dir, image_format):
+    """ Pair each file with its image, keeping the directory layout below the common directory of the files """
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in filenames])
+    jobs = []
+    for filename in filenames:
+        name = os.path.splitext(os.path.relpath(os.path.abspath(filename), root))[0]
+        jobs.append((filename, os.path.join(output_dir, f"{name}.{image_format}")))
+    return jobs
+
+
+def render_batch(jobs, variant, num_workers, cache_dir=None):
+    # Several jobs per message keeps the pool busy with many small files, a few chunks per worker balance the load
+    chunksize = max(1, len(jobs) // (4 * num_workers))
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                             initargs=(variant, cache_dir)) as executor:
+        results = []
+        for result in executor.map(render_job, jobs, chunksize=chunksize):
+            results.append(result)
+            if result["error"]:
+                print(f"{result['file']}: {result['error']}")
+    return results
+
+
+""" main loop """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch rendering of turtle graphics command files")
+    parser.add_argument("pattern", help="glob of command files, ** matches subdirectories")
+    parser.add_argument("-d", "--output-dir", default="images", help="directory of the images")
+    parser.add_argument("--format", default="png", help="image format, the extension of the images")
+    parser.add_argument("--variant", choices=list(modules_variant), default="2d",
+                        help="turtle graphics module the files are written for")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--cache-dir", help="directory of the compiled program cache shared by the workers")
+    parser.add_argument("-o", "--output", help="write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    filenames = sorted(glob.glob(args.pattern, recursive=True))
+    if not filenames:
+        parser.error(f"no files match {args.pattern}")
+    jobs = make_jobs(filenames, args.output_dir, args.format)
+
+    time_start = time.perf_counter()
+    results = render_batch(jobs, args.variant, max(1, args.jobs), args.cache_dir)
+    seconds = time.perf_counter() - time_start
+
+    num_errors = sum(1 for result in results if result["error"])
+    print(f"{len(results) - num_errors} rendered, {num_errors} failed in {seconds:.2f} s "
+          f"({len(results) / seconds:.1f} files/sec, {args.jobs} workers)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "variant": args.variant,
+                "workers": args.jobs,
+                "seconds": seconds,
+                "rendered": len(results) - num_errors,
+                "failed": num_errors,
+                "results": results,
+            }, f, indent=2)
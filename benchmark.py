@@ -0,0 +1,195 @@
+""" Benchmark of turtle graphics
+
+Runs headless on the Agg canvas and measures
+- parse: Interpreter.load_program (lines/sec)
+- step: Interpreter.step (steps/sec)
+- forward: Turtle.forward / Turtle3d.forward_step followed by one view update (sec/call) vs. path length
+- draw: full canvas draw and one blitted frame (sec/frame) vs. path length
+
+Usage:
+python benchmark.py --sizes 1000,10000,100000,1000000 -o bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import turtle_graphics
+import turtle_graphics_3d
+
+""" Global variables """
+sizes_default = [1000, 10000, 100000, 1000000]
+num_calls_forward = 200
+num_frames = 20
+
+""" Classes and functions """
+
+
+def generate_flat_program(num_commands, is3d=False):
+    """ Program without repeat blocks, like a pre-expanded L-system """
+    turns = ["right", "left", "up", "down"] if is3d else ["right", "left"]
+    lines = []
+    for i in range(num_commands):
+        if i % 2 == 0:
+            lines.append(f"forward {i % 7 + 1}\n")
+        else:
+            lines.append(f"{turns[i // 2 % len(turns)]} {i % 89 + 1}\n")
+    return lines
+
+
+def generate_loop_program(num_steps, is3d=False):
+    """ Program with a repeat block executing about num_steps steps """
+    turn = "up" if is3d else "right"
+    return [
+        "pendown\n",
+        f"repeat {max(num_steps // 3, 1)} [\n",
+        "    forward 1\n",
+        f"    {turn} 7\n",
+        "]\n",
+    ]
+
+
+def setup(module):
+    """ Create the interpreter, turtle and view of a turtle graphics module on a fresh Agg canvas """
+    for artist in list(module.ax0.lines) + list(module.ax0.patches) + list(module.ax0.collections):
+        artist.remove()
+    canvas = FigureCanvasAgg(module.fig)
+    module.interpreter = module.Interpreter()
+    if module is turtle_graphics_3d:
+        module.my_turtle = module.Turtle3d(xyz=np.array([0., 0., 0.]), direction=0.)
+        module.my_turtle_view = module.Turtle3dView(ax=module.ax0, turtle=module.my_turtle,
+                                                    size=module.size_turtle, color="green")
+    else:
+        module.my_turtle = module.Turtle(xy=np.array([0, 0]), direction=0)
+        module.my_turtle_view = module.TurtleView(ax=module.ax0, turtle=module.my_turtle,
+                                                  size=module.size_turtle, color="green")
+    return canvas
+
+
+def fill_path(module, num_vertices):
+    """ Put num_vertices vertices on the path of the current view without timing """
+    turtle = module.my_turtle
+    view = module.my_turtle_view
+    turtle.pendown()
+    if module is turtle_graphics_3d:
+        for i in range(num_vertices):
+            turtle.xyz = np.array([np.cos(i), np.sin(i), 0.01 * (i % 100)]) * 80.
+            turtle.events.append((module.EV_MOVE, turtle.xyz))
+    else:
+        angles = np.arange(num_vertices, dtype=np.float64)
+        turtle.events.append((module.EV_MOVES, 80. * np.column_stack((np.cos(angles), np.sin(angles)))))
+    view.update_draw()
+
+
+def bench_parse(module, size):
+    lines = generate_flat_program(size, is3d=module is turtle_graphics_3d)
+    interpreter = module.Interpreter()
+    t = time.perf_counter()
+    interpreter.load_program(lines)
+    seconds = time.perf_counter() - t
+    return {"seconds": seconds, "rate": size / seconds, "unit": "lines/sec"}
+
+
+def bench_step(module, size, program):
+    setup(module)
+    lines = program(size, is3d=module is turtle_graphics_3d)
+    module.interpreter.load_program(lines)
+    num_steps = 0
+    t = time.perf_counter()
+    while module.interpreter.step():
+        num_steps += 1
+        if num_steps % 10000 == 0:
+            module.my_turtle_view.consume_events()
+    seconds = time.perf_counter() - t
+    return {"seconds": seconds, "steps": num_steps, "rate": num_steps / seconds, "unit": "steps/sec"}
+
+
+def bench_forward(module, size):
+    setup(module)
+    fill_path(module, size)
+    turtle = module.my_turtle
+    forward = turtle.forward_step if module is turtle_graphics_3d else turtle.forward
+    t = time.perf_counter()
+    for i in range(num_calls_forward):
+        forward(1)
+        module.my_turtle_view.update_draw()
+    seconds = (time.perf_counter() - t) / num_calls_forward
+    return {"seconds": seconds, "rate": 1. / seconds, "unit": "calls/sec"}
+
+
+def bench_draw(module, size):
+    canvas = setup(module)
+    fill_path(module, size)
+    blit_manager = module.BlitManager(canvas, views=[module.my_turtle_view])
+
+    t = time.perf_counter()
+    for i in range(num_frames):
+        canvas.draw()
+    seconds_full = (time.perf_counter() - t) / num_frames
+
+    t = time.perf_counter()
+    for i in range(num_frames):
+        module.my_turtle.forward(1)
+        module.my_turtle_view.update_draw()
+        blit_manager.update()
+    seconds_blit = (time.perf_counter() - t) / num_frames
+    canvas.mpl_disconnect(blit_manager.cid)
+    return {"seconds": seconds_full, "seconds_blit": seconds_blit, "rate": 1. / seconds_full, "unit": "frames/sec"}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes):
+    results = []
+    benchmarks = [
+        ("parse", bench_parse),
+        ("step_flat", lambda module, size: bench_step(module, size, generate_flat_program)),
+        ("step_loop", lambda module, size: bench_step(module, size, generate_loop_program)),
+        ("forward", bench_forward),
+        ("draw", bench_draw),
+    ]
+    for module in [turtle_graphics, turtle_graphics_3d]:
+        variant = "3d" if module is turtle_graphics_3d else "2d"
+        for name, bench in benchmarks:
+            for size in sizes:
+                module.trace.level = module.TRACE_OFF
+                result = bench(module, size)
+                result.update({"benchmark": name, "variant": variant, "size": size})
+                results.append(result)
+                print(f"{name:10s} {variant} size={size:8d} {result['rate']:14.1f} {result['unit']}")
+    return results
+
+
+""" main loop """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of turtle graphics")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in sizes_default),
+                        help="comma separated program sizes / path lengths")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmarks([int(size) for size in args.sizes.split(",")])
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -14,26 +14,51 @@ repeat 12 [
 ]
 """
 
+import argparse
+import bisect
+import hashlib
+import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 import numpy as np
 from matplotlib.figure import Figure
-import matplotlib.animation as animation
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-import tkinter as tk
-from tkinter import ttk
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import proj3d
 
-from decimal import Decimal, getcontext
-getcontext().prec = 50
+from fractions import Fraction
 
 """ Global variables """
 size_turtle = 5
+size_stack = 64  # Rows preallocated for the push / pop stack of a turtle, doubled when full
+version_compiler = 5  # Bump when the parser or the opcodes change to invalidate cached programs
+
+""" Trace levels """
+TRACE_OFF = 0       # Silent
+TRACE_SUMMARY = 1   # End of programs and unknown commands
+TRACE_COMMAND = 2   # Every executed command
+TRACE_DEBUG = 3     # Variables and repeat iterations
 
 """ Animation control """
+steps_per_frame = 1         # Max interpreter steps per animation frame
+budget_ms_per_frame = 0.    # Time budget of interpreter steps per animation frame (0: no limit)
+steps_fast_forward = 10000  # Steps per chunk of a run to the end, Tkinter handles its events between chunks
+moves_batch = 1 << 16       # Max turns and moves of a pure repeat block applied at once, the iterations are split beyond it
+is_fast_forward = False     # Running to the end, frames are not drawn
+engine = None               # Engine running the interpreter on a worker thread, None to run it in the animation timer
 is_play = False
+is_run = False
 
 """ Axis vectors """
+vectors_heading_axes = (np.array([1., 0.]), np.array([0., 1.]), np.array([-1., 0.]), np.array([0., -1.]))  # Heading 0, 90, 180, 270 deg
 
 """ Other parameters """
+size_cell_lod = 0.25  # Pixels, consecutive path vertices in the same cell are drawn as one
+size_chunk = 4096  # Vertices of the drawn path per frozen line, cut at a pen up gap where possible
 
 """ Create figure and axes """
 title_ax0 = "Turtle graphics"
@@ -56,20 +81,107 @@ ax0.set_ylabel("y")
 ax0.set_xlim(x_min, x_max)
 ax0.set_ylim(y_min, y_max)
 
-""" Embed in Tkinter """
-root = tk.Tk()
-root.title(title_tk)
-canvas = FigureCanvasTkAgg(fig, root)
-canvas.get_tk_widget().pack(expand=True, fill="both")
-
-toolbar = NavigationToolbar2Tk(canvas, root)
-canvas.get_tk_widget().pack()
-
 """ Global objects of Tkinter """
+var_steps = None
+var_budget = None
+root = None
+canvas = None
+toolbar = None
+scl_seek = None
 
 """ Classes and functions """
 
 
+class Trace:
+    """ Leveled trace messages, buffered and optionally sampled """
+    def __init__(self, level=TRACE_COMMAND, sample=1, size_buffer=256):
+        self.level = level
+        self.sample = sample            # Write every sample-th message of command and debug levels
+        self.size_buffer = size_buffer  # Flush when this many lines are buffered
+        self.buffer = []
+        self.num_messages = 0
+
+    def write(self, level, message):
+        """ Buffer a message, the caller checks self.level first to skip formatting it """
+        if level > TRACE_SUMMARY and self.sample > 1:
+            self.num_messages += 1
+            if self.num_messages % self.sample:
+                return
+        self.buffer.append(message)
+        if len(self.buffer) >= self.size_buffer:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            sys.stdout.write("\n".join(self.buffer) + "\n")
+            sys.stdout.flush()
+            self.buffer = []
+
+
+trace = Trace()
+
+
+class ProgramUnpickler(pickle.Unpickler):
+    """ Load cached programs, Command is the only class allowed whichever module pickled it """
+    def find_class(self, module, name):
+        if name == "Command":
+            return Command
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a cached program")
+
+
+class ProgramCache:
+    """ Compiled programs by content hash, in memory (LRU) and optionally as pickle files in a directory """
+    def __init__(self, size=16, directory=None):
+        self.size = size
+        self.directory = directory
+        self.programs = OrderedDict()
+
+    def key(self, f):
+        """ Hash of the content of a binary file, read in chunks, and of the compiler """
+        digest = hashlib.sha256(f"{os.path.basename(__file__)} {version_compiler}\n".encode())
+        for chunk in iter(lambda: f.read(size_chunk_hash), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key):
+        program = self.programs.get(key)
+        if program is not None:
+            self.programs.move_to_end(key)
+            return program
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, key + ".pickle"), "rb") as f:
+                program = ProgramUnpickler(f).load()
+        except Exception:
+            return None  # Missing or unreadable, parse again
+        self.remember(key, program)
+        return program
+
+    def put(self, key, program):
+        self.remember(key, program)
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, key + ".pickle")
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(program, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Error while saving compiled program: {e}")
+
+    def remember(self, key, program):
+        self.programs[key] = program
+        self.programs.move_to_end(key)
+        while len(self.programs) > self.size:
+            self.programs.popitem(last=False)
+
+
+program_cache = ProgramCache()
+size_chunk_hash = 1 << 20  # Bytes of a command file read at once to hash it
+
+
 class Counter:
     def __init__(self, is3d=None, ax=None, xy=None, z=None, label=""):
         self.is3d = is3d if is3d is not None else False
@@ -87,8 +199,8 @@ class Counter:
             self.xz, self.yz, _ = proj3d.proj_transform(self.x, self.y, self.z, self.ax.get_proj())
             self.txt_step.set_position((self.xz, self.yz))
 
-    def count_up(self):
-        self.count += 1
+    def count_up(self, num=1):
+        self.count += num
         self.txt_step.set_text(self.label + str(self.count))
 
     def reset(self):
@@ -99,280 +211,1511 @@ class Counter:
         return self.count
 
 
+class PathBuffer:
+    """ Growable float64 array of path vertices, a row of NaN separates strokes (pen up) """
+    def __init__(self, dim, capacity=1024):
+        self.data = np.empty((capacity, dim), dtype=np.float64)
+        self.capacity = capacity
+        self.size = 0
+        self.start = 0  # First vertex of the path, cleared vertices before it are kept for seeking back
+        self.size_max = 0  # Vertices after size up to here are kept for seeking forward, as of the last seek
+
+    def __len__(self):
+        return self.size - self.start
+
+    def grow(self):
+        data = np.empty((2 * len(self.data), self.data.shape[1]), dtype=np.float64)
+        size = max(self.size, self.size_max)
+        data[:size] = self.data[:size]
+        self.data = data
+
+    def extend(self, points):
+        while self.size + len(points) > len(self.data):
+            self.grow()
+        self.data[self.size:self.size + len(points)] = points
+        self.size += len(points)
+
+    def clear(self):
+        self.start = self.size
+
+    def drop(self, count):
+        """ Free the first count vertices once nothing seeks back to them, positions count from the next one """
+        size = self.size - count
+        data = np.empty((max(self.capacity, 2 * size), self.data.shape[1]), dtype=np.float64)
+        data[:size] = self.data[count:self.size]
+        self.data = data
+        self.size = size
+        self.start = max(self.start - count, 0)
+        self.size_max = 0
+
+    def seek(self, start, size):
+        """ Restore the path of a keyframe, start and size count the vertices appended since creation.
+        Replaying a program appends the same vertices again, so the ones after a keyframe stay valid """
+        self.size_max = max(self.size, self.size_max)
+        self.size = min(size, self.size_max)
+        self.start = min(start, self.size)
+
+    def view(self):
+        """ Return the stored vertices without copying, one row per vertex """
+        return self.data[self.start:self.size]
+
+
+class BlitManager:
+    """ Redraw only the animated artists over a cached background, new path segments are committed into it """
+    def __init__(self, canvas, artists=(), views=()):
+        self.canvas = canvas
+        self.background = None
+        self.artists = []
+        self.views = []
+        for artist in artists:
+            self.add_artist(artist)
+        for view in views:
+            self.add_view(view)
+        self.cid = self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+    def add_view(self, view):
+        self.views.append(view)
+
+    def on_draw(self, event):
+        """ Cache the background after a full redraw (start, resize, zoom, reset) """
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        for view in self.views:
+            view.commit_stroke()
+        self.draw_animated()
+
+    def draw_animated(self):
+        for view in self.views:
+            view.draw_animated()
+        for artist in self.artists:
+            self.canvas.figure.draw_artist(artist)
+
+    def update(self):
+        if self.background is None or any(view.is_path_cleared for view in self.views):
+            # The cached background is stale, wait for a full redraw
+            self.background = None
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        if any([view.draw_stroke() for view in self.views]):
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+
+
+""" Turtle events """
+EV_MOVE = 0     # Moved forward: data (x, y) after the move
+EV_MOVES = 1    # Moved forward several times at once: data array of positions after each move
+EV_TURN = 2     # Heading changed: data heading in degrees
+EV_PEN = 3      # Pen state changed: data is_pen_down
+EV_RESET = 4    # Back to the origin with an empty path: data None
+EV_SEEK = 5     # State restored from a keyframe: data Turtle.snapshot()
+EV_SWARM = 6    # Turtles of a swarm moved: data (positions before or None, positions after or None without a swarm)
+EV_JUMP = 7     # Popped a state: data (x, y), heading, is_pen_down and whether a gap starts on the path
+EV_FORGET = 8   # Path before the last reset dropped: data number of vertices dropped
+
+
 class Turtle:
-    def __init__(self, ax=None, xy=None, direction=None, size=None, color=None):
-        self.ax = ax
+    """ Pose and pen of a turtle, every change is queued in self.events for the view """
+    def __init__(self, xy=None, direction=None):
         self.xy = np.array(xy, dtype=np.float64)
-        self.direction = Decimal(direction)
-        self.size = size
-        self.color = color
+        self.set_direction(direction)
+        self.is_pen_down = False
+        self.num_vertices = 0  # Vertices appended to the view's path and first one after the last reset, for keyframes
+        self.start_path = 0
+        self.events = deque()
+
+        # Swarm of turtles spawned from this one, structure of arrays with one row per turtle, turtle 0 is this one.
+        # Arrays are replaced, never changed in place, so snapshots and events can keep them
+        self.swarm_xy = None       # Positions
+        self.swarm_offsets = None  # Heading relative to self.direction (deg)
+        self.swarm_vectors = None  # Unit vectors of the headings
+
+        # States saved by push, one row each: x, y, heading and is_pen_down
+        self.stack = np.empty((size_stack, 4), dtype=np.float64)
+        self.depth_stack = 0
+        self.is_gap = False  # The path ends with the gap of a jump, the position is appended once drawing resumes
+
+    def set_direction(self, direction_deg):
+        """ Set heading in degrees, kept exact as int or Fraction, and cache its radian and unit vector """
+        if direction_deg.__class__ is not int:
+            direction_deg = Fraction(direction_deg)
+        self.direction = direction_deg % 360
+        self.direction_rad = np.deg2rad(float(self.direction))
+        if self.direction % 90 == 0:
+            self.vector_direction = vectors_heading_axes[int(self.direction // 90)]
+        else:
+            self.vector_direction = np.array([np.cos(self.direction_rad), np.sin(self.direction_rad)], dtype=np.float64)
+
+    def pendown(self):
+        self.is_pen_down = True
+        self.is_gap = False
+        self.num_vertices += 1
+        self.events.append((EV_PEN, True))
 
-        self.x_body, self.y_body = self.points_polygon(6, self.size, self.xy, self.direction)
-        self.body, = self.ax.fill(self.x_body, self.y_body, "-", color=self.color)
+    def penup(self):
+        self.is_pen_down = False
+        self.events.append((EV_PEN, False))
 
-        self.xy_head = self.xy + self.size * np.array([np.cos(float(self.direction)), np.sin(float(self.direction))], dtype=np.float64)
-        self.x_head, self.y_head = self.points_polygon(4, self.size * 0.4, self.xy_head, self.direction)
-        self.head, = self.ax.fill(self.x_head, self.y_head, "-", color=self.color)
+    def forward(self, distance):
+        if self.swarm_xy is not None:
+            self.forward_swarm(distance)
+            return
+        if self.is_gap and self.is_pen_down:
+            self.pendown()  # Start of the path after a jump
+        self.xy += float(distance) * self.vector_direction
+        self.num_vertices += 1
+        self.events.append((EV_MOVE, (self.xy[0], self.xy[1])))
 
-        self.xy_arm_right = self.xy + self.size * np.array([np.cos(float(self.direction) - np.pi / 3), np.sin(float(self.direction) - np.pi / 3)], dtype=np.float64)
-        self.x_arm_right, self.y_arm_right = self.points_polygon(4, self.size * 0.2, self.xy_arm_right, self.direction)
-        self.arm_right, = self.ax.fill(self.x_arm_right, self.y_arm_right, "-", color=self.color)
+    def right(self, angle_deg):
+        self.set_direction(self.direction - angle_deg)
+        if self.swarm_xy is not None:
+            self.set_swarm_vectors()
+        self.events.append((EV_TURN, self.direction))
 
-        self.xy_arm_left = self.xy + self.size * np.array([np.cos(float(self.direction) + np.pi / 3), np.sin(float(self.direction) + np.pi / 3)], dtype=np.float64)
-        self.x_arm_left, self.y_arm_left = self.points_polygon(4, self.size * 0.2, self.xy_arm_left, self.direction)
-        self.arm_left, = self.ax.fill(self.x_arm_left, self.y_arm_left, "-", color=self.color)
+    def left(self, angle_deg):
+        self.set_direction(self.direction + angle_deg)
+        if self.swarm_xy is not None:
+            self.set_swarm_vectors()
+        self.events.append((EV_TURN, self.direction))
+
+    def spawn(self, count, spread_deg=360):
+        """ Turn into count turtles at the current position, headings spread_deg / count apart.
+        Later commands move and turn all of them at once, a count of 1 goes back to a single turtle """
+        if count > 1:
+            self.swarm_xy = np.tile(self.xy, (count, 1))
+            self.swarm_offsets = spread_deg * np.arange(count, dtype=np.float64) / count
+            self.set_swarm_vectors()
+            self.events.append((EV_SWARM, (None, self.swarm_xy)))
+        elif self.swarm_xy is not None:
+            self.end_swarm()
+            if self.is_pen_down:
+                self.is_gap = False
+                self.num_vertices += 1  # The path of the single turtle starts again at its position
+            self.events.append((EV_SWARM, (None, None)))
+
+    def end_swarm(self):
+        self.swarm_xy = None
+        self.swarm_offsets = None
+        self.swarm_vectors = None
+
+    def set_swarm_vectors(self):
+        headings = (float(self.direction) + self.swarm_offsets) % 360
+        vectors = np.column_stack((np.cos(np.deg2rad(headings)), np.sin(np.deg2rad(headings))))
+        on_axes = headings % 90 == 0
+        vectors[on_axes] = np.round(vectors[on_axes])  # Exact as vectors_heading_axes
+        self.swarm_vectors = vectors
+
+    def forward_swarm(self, distance):
+        """ Move every turtle of the swarm, one segment each on the path """
+        start = self.swarm_xy
+        self.swarm_xy = start + float(distance) * self.swarm_vectors
+        self.xy = self.swarm_xy[0].copy()
+        self.num_vertices += 3 * len(start) if self.is_pen_down else 1  # Start, end and gap of each segment, or one gap
+        self.events.append((EV_SWARM, (start, self.swarm_xy)))
+
+    def move_batch(self, angles, distances, is_move, turn):
+        """ Apply a sequence of turns (deg, counterclockwise) and forward moves at once,
+        turn is the exact sum of the angles as int or Fraction """
+        if self.swarm_xy is not None:
+            # Each command is already vectorized over the turtles
+            for angle, distance, move in zip(angles, distances, is_move):
+                if move:
+                    self.forward_swarm(distance)
+                else:
+                    self.left(int(angle) if angle.is_integer() else float(angle))
+            return
+        direction = self.direction if self.direction.__class__ is int else float(self.direction)
+        headings = (direction + np.cumsum(angles))[is_move] % 360
+        vectors = np.column_stack((np.cos(np.deg2rad(headings)), np.sin(np.deg2rad(headings))))
+        on_axes = headings % 90 == 0
+        vectors[on_axes] = np.round(vectors[on_axes])  # Exact as vectors_heading_axes
+        points = self.xy + np.cumsum(distances[is_move, None] * vectors, axis=0)
+
+        if len(points) > 0:
+            if self.is_gap and self.is_pen_down:
+                self.pendown()
+            self.xy = points[-1].copy()
+            self.num_vertices += len(points)
+            self.events.append((EV_MOVES, points))
+        self.set_direction(self.direction + turn)
+        self.events.append((EV_TURN, self.direction))
+
+    def push(self):
+        """ Save position, heading and pen on the stack """
+        self.reserve_stack(self.depth_stack + 1)
+        self.stack[self.depth_stack] = (self.xy[0], self.xy[1], float(self.direction), self.is_pen_down)
+        self.depth_stack += 1
+
+    def pop(self):
+        """ Jump to the last pushed state without drawing, a swarm ends first.
+        The path gets one gap for consecutive jumps, the position is appended when drawing resumes """
+        if self.swarm_xy is not None:
+            self.spawn(1)
+        self.depth_stack -= 1
+        x, y, direction, is_pen_down = self.stack[self.depth_stack]
+        is_gap = not self.is_gap and (x != self.xy[0] or y != self.xy[1])
+        if is_gap:
+            self.num_vertices += 1
+            self.is_gap = True
+        was_pen_down = self.is_pen_down
+        self.xy = np.array([x, y], dtype=np.float64)
+        self.set_direction(int(direction) if direction.is_integer() else direction)
+        self.is_pen_down = bool(is_pen_down)
+        self.events.append((EV_JUMP, ((x, y), self.direction, self.is_pen_down, is_gap)))
+        if self.is_pen_down and not was_pen_down and not self.is_gap:
+            self.pendown()
+
+    def reserve_stack(self, depth):
+        """ Grow the stack to hold depth states """
+        if depth > len(self.stack):
+            stack = np.empty((max(depth, 2 * len(self.stack)), self.stack.shape[1]), dtype=np.float64)
+            stack[:self.depth_stack] = self.stack[:self.depth_stack]
+            self.stack = stack
 
-        self.xy_leg_right = self.xy + self.size * np.array([np.cos(float(self.direction) - 2 * np.pi / 3), np.sin(float(self.direction) - 2 * np.pi / 3)], dtype=np.float64)
-        self.x_leg_right, self.y_leg_right = self.points_polygon(4, self.size * 0.2, self.xy_leg_right, self.direction)
-        self.leg_right, = self.ax.fill(self.x_leg_right, self.y_leg_right, "-", color=self.color)
+    def reset(self):
+        self.set_direction(0)
+        self.xy = np.array([0., 0.], dtype=np.float64)
+        self.end_swarm()
+        self.depth_stack = 0
+        self.is_gap = False
+        self.start_path = self.num_vertices
+        self.events.append((EV_RESET, None))
+
+    def forget_path(self):
+        """ Drop the path before the last reset, once no keyframe or undo record can go back to it """
+        if self.start_path:
+            self.events.append((EV_FORGET, self.start_path))
+            self.num_vertices -= self.start_path
+            self.start_path = 0
+
+    def snapshot(self):
+        """ State for keyframes """
+        swarm = (self.swarm_xy, self.swarm_offsets) if self.swarm_xy is not None else None
+        return (self.xy.copy(), self.direction, self.is_pen_down, self.start_path, self.num_vertices, swarm,
+                self.stack[:self.depth_stack].copy(), self.is_gap)
+
+    def restore(self, snapshot):
+        xy, direction, self.is_pen_down, self.start_path, self.num_vertices, swarm, stack, self.is_gap = snapshot
+        self.xy = xy.copy()
+        self.set_direction(direction)
+        self.reserve_stack(len(stack))
+        self.stack[:len(stack)] = stack
+        self.depth_stack = len(stack)
+        if swarm is not None:
+            self.swarm_xy, self.swarm_offsets = swarm
+            self.set_swarm_vectors()
+        else:
+            self.end_swarm()
+        self.events.append((EV_SEEK, snapshot))
 
-        self.xy_leg_left = self.xy + self.size * np.array([np.cos(float(self.direction) + 2 * np.pi / 3), np.sin(float(self.direction) + 2 * np.pi / 3)], dtype=np.float64)
-        self.x_leg_left, self.y_leg_left = self.points_polygon(4, self.size * 0.2, self.xy_leg_left, self.direction)
-        self.leg_left, = self.ax.fill(self.x_leg_left, self.y_leg_left, "-", color=self.color)
 
-        self.x_path = []
-        self.y_path = []
-        self.path, = self.ax.plot(np.array(self.x_path, dtype=np.float64), np.array(self.y_path, dtype=np.float64))
+class TurtleView:
+    """ Artists of a turtle, updated from the turtle's events once per frame """
+    def __init__(self, ax=None, turtle=None, size=None, color=None):
+        self.ax = ax
+        self.turtle = turtle
+        self.events = turtle.events  # Queue of the turtle's events, a separate one when an Engine runs the interpreter
+        self.size = size
+        self.color = color
 
-        self.is_pen_down = False
+        # Pose as of the last consumed event
+        self.xy = turtle.xy.copy()
+        self.direction_rad = turtle.direction_rad
+        self.is_pen_down = turtle.is_pen_down
+
+        self.x_body, self.y_body = self.points_polygon(6, self.size, self.xy, self.direction_rad)
+        self.body, = self.ax.fill(self.x_body, self.y_body, "-", color=self.color, animated=True)
+
+        self.xy_head = self.xy + self.size * np.array([np.cos(self.direction_rad), np.sin(self.direction_rad)], dtype=np.float64)
+        self.x_head, self.y_head = self.points_polygon(4, self.size * 0.4, self.xy_head, self.direction_rad)
+        self.head, = self.ax.fill(self.x_head, self.y_head, "-", color=self.color, animated=True)
+
+        self.xy_arm_right = self.xy + self.size * np.array([np.cos(self.direction_rad - np.pi / 3), np.sin(self.direction_rad - np.pi / 3)], dtype=np.float64)
+        self.x_arm_right, self.y_arm_right = self.points_polygon(4, self.size * 0.2, self.xy_arm_right, self.direction_rad)
+        self.arm_right, = self.ax.fill(self.x_arm_right, self.y_arm_right, "-", color=self.color, animated=True)
+
+        self.xy_arm_left = self.xy + self.size * np.array([np.cos(self.direction_rad + np.pi / 3), np.sin(self.direction_rad + np.pi / 3)], dtype=np.float64)
+        self.x_arm_left, self.y_arm_left = self.points_polygon(4, self.size * 0.2, self.xy_arm_left, self.direction_rad)
+        self.arm_left, = self.ax.fill(self.x_arm_left, self.y_arm_left, "-", color=self.color, animated=True)
+
+        self.xy_leg_right = self.xy + self.size * np.array([np.cos(self.direction_rad - 2 * np.pi / 3), np.sin(self.direction_rad - 2 * np.pi / 3)], dtype=np.float64)
+        self.x_leg_right, self.y_leg_right = self.points_polygon(4, self.size * 0.2, self.xy_leg_right, self.direction_rad)
+        self.leg_right, = self.ax.fill(self.x_leg_right, self.y_leg_right, "-", color=self.color, animated=True)
+
+        self.xy_leg_left = self.xy + self.size * np.array([np.cos(self.direction_rad + 2 * np.pi / 3), np.sin(self.direction_rad + 2 * np.pi / 3)], dtype=np.float64)
+        self.x_leg_left, self.y_leg_left = self.points_polygon(4, self.size * 0.2, self.xy_leg_left, self.direction_rad)
+        self.leg_left, = self.ax.fill(self.x_leg_left, self.y_leg_left, "-", color=self.color, animated=True)
+
+        self.path_xy = PathBuffer(2)
+        self.path, = self.ax.plot(self.path_xy.view()[:, 0], self.path_xy.view()[:, 1])
+        self.stroke, = self.ax.plot([], [], color=self.path.get_color(), animated=True)
+        self.i_committed = 0  # Number of path vertices already drawn in the blit background
+        self.is_path_cleared = False
+        self.swarm_xy = None  # Positions of the turtles of a swarm
+        self.swarm, = self.ax.plot([], [], ".", color=self.color, markersize=2, animated=True)
+
+        # Level of detail: the drawn path is decimated to one vertex per pixel cell of the current zoom
+        self.path_lod = PathBuffer(2)
+        self.i_lod = 0  # Number of path vertices already decimated
+        self.cell_lod = None  # Cell of the last decimated vertex
+        self.linear_lod = None  # Scale and rotation of transData the decimation is valid for, None to recompute
+        self.chunks = []  # Frozen lines of the decimated path, self.path only holds the vertices after them
+        self.i_frozen = 0  # Number of decimated vertices in the frozen lines
+        self.ax.callbacks.connect("xlim_changed", self.on_limits_changed)
+        self.ax.callbacks.connect("ylim_changed", self.on_limits_changed)
+        self.ax.figure.canvas.mpl_connect("resize_event", self.on_resize)
 
     def points_polygon(self, num_sides, radius, xy, direction):
         theta = np.linspace(0, 2 * np.pi, num_sides + 1, dtype=np.float64)
-        x = radius * np.cos(theta + float(direction)) + xy[0]
-        y = radius * np.sin(theta + float(direction)) + xy[1]
+        x = radius * np.cos(theta + direction) + xy[0]
+        y = radius * np.sin(theta + direction) + xy[1]
         return x, y
 
+    def consume_events(self):
+        """ Apply the queued turtle events to the path, only the latest pose is kept """
+        events = self.events
+        vertices = []
+        while events:
+            kind, data = events.popleft()
+            if kind == EV_MOVE:
+                vertices.append(data if self.is_pen_down else (np.nan, np.nan))
+                self.xy = data
+            elif kind == EV_TURN:
+                self.direction_rad = np.deg2rad(float(data))
+            elif kind == EV_PEN:
+                self.is_pen_down = data
+                if data:
+                    vertices.append(self.xy)
+            elif kind == EV_MOVES:
+                if vertices:
+                    self.path_xy.extend(np.array(vertices, dtype=np.float64))
+                    vertices = []
+                self.path_xy.extend(data if self.is_pen_down else np.full(data.shape, np.nan))
+                self.xy = data[-1]
+            elif kind == EV_SWARM:
+                start, end = data
+                if start is not None:
+                    if self.is_pen_down:
+                        if vertices:
+                            self.path_xy.extend(np.array(vertices, dtype=np.float64))
+                            vertices = []
+                        # One segment per turtle, all of them in a single extend
+                        segments = np.empty((len(end), 3, 2), dtype=np.float64)
+                        segments[:, 0] = start
+                        segments[:, 1] = end
+                        segments[:, 2] = np.nan
+                        self.path_xy.extend(segments.reshape(-1, 2))
+                    else:
+                        vertices.append((np.nan, np.nan))
+                elif end is None and self.is_pen_down:
+                    vertices.append(self.xy)
+                if end is not None:
+                    self.xy = (end[0, 0], end[0, 1])
+                self.swarm_xy = end
+            elif kind == EV_JUMP:
+                self.xy, direction, self.is_pen_down, is_gap = data
+                if is_gap:
+                    vertices.append((np.nan, np.nan))
+                self.direction_rad = np.deg2rad(float(direction))
+            elif kind == EV_SEEK:
+                if vertices:
+                    self.path_xy.extend(np.array(vertices, dtype=np.float64))
+                    vertices = []
+                xy, direction, self.is_pen_down, start_path, num_vertices, swarm, _, _ = data
+                self.xy = (xy[0], xy[1])
+                self.swarm_xy = swarm[0] if swarm is not None else None
+                self.direction_rad = np.deg2rad(float(direction))
+                self.path_xy.seek(start_path, num_vertices)
+                self.i_committed = 0
+                self.linear_lod = None
+                self.is_path_cleared = True
+            elif kind == EV_FORGET:
+                if vertices:
+                    self.path_xy.extend(np.array(vertices, dtype=np.float64))
+                    vertices = []
+                self.path_xy.drop(data)
+            elif kind == EV_RESET:
+                if vertices:
+                    self.path_xy.extend(np.array(vertices, dtype=np.float64))  # Kept before the start for seeking
+                    vertices = []
+                self.path_xy.clear()
+                self.i_committed = 0
+                self.linear_lod = None
+                self.is_path_cleared = True
+                self.swarm_xy = None
+                self.xy = (0., 0.)
+                self.direction_rad = 0.
+        if vertices:
+            self.path_xy.extend(np.array(vertices, dtype=np.float64))
+
     def update_draw(self):
-        self.x_body, self.y_body = self.points_polygon(6, self.size, self.xy, self.direction)
+        self.consume_events()
+
+        self.x_body, self.y_body = self.points_polygon(6, self.size, self.xy, self.direction_rad)
         self.body.set_xy(np.column_stack((self.x_body, self.y_body)))
 
-        self.xy_head = self.xy + self.size * np.array([np.cos(float(self.direction)), np.sin(float(self.direction))], dtype=np.float64)
-        self.x_head, self.y_head = self.points_polygon(4, self.size * 0.4, self.xy_head, self.direction)
+        self.xy_head = self.xy + self.size * np.array([np.cos(self.direction_rad), np.sin(self.direction_rad)], dtype=np.float64)
+        self.x_head, self.y_head = self.points_polygon(4, self.size * 0.4, self.xy_head, self.direction_rad)
         self.head.set_xy(np.column_stack((self.x_head, self.y_head)))
 
-        self.xy_arm_right = self.xy + self.size * np.array([np.cos(float(self.direction) - np.pi / 3), np.sin(float(self.direction) - np.pi / 3)], dtype=np.float64)
-        self.x_arm_right, self.y_arm_right = self.points_polygon(4, self.size * 0.2, self.xy_arm_right, self.direction)
+        self.xy_arm_right = self.xy + self.size * np.array([np.cos(self.direction_rad - np.pi / 3), np.sin(self.direction_rad - np.pi / 3)], dtype=np.float64)
+        self.x_arm_right, self.y_arm_right = self.points_polygon(4, self.size * 0.2, self.xy_arm_right, self.direction_rad)
         self.arm_right.set_xy(np.column_stack((self.x_arm_right, self.y_arm_right)))
 
-        self.xy_arm_left = self.xy + self.size * np.array([np.cos(float(self.direction) + np.pi / 3), np.sin(float(self.direction) + np.pi / 3)], dtype=np.float64)
-        self.x_arm_left, self.y_arm_left = self.points_polygon(4, self.size * 0.2, self.xy_arm_left, self.direction)
+        self.xy_arm_left = self.xy + self.size * np.array([np.cos(self.direction_rad + np.pi / 3), np.sin(self.direction_rad + np.pi / 3)], dtype=np.float64)
+        self.x_arm_left, self.y_arm_left = self.points_polygon(4, self.size * 0.2, self.xy_arm_left, self.direction_rad)
         self.arm_left.set_xy(np.column_stack((self.x_arm_left, self.y_arm_left)))
 
-        self.xy_leg_right = self.xy + self.size * np.array([np.cos(float(self.direction) - 2 * np.pi / 3), np.sin(float(self.direction) - 2 * np.pi / 3)], dtype=np.float64)
-        self.x_leg_right, self.y_leg_right = self.points_polygon(4, self.size * 0.2, self.xy_leg_right, self.direction)
+        self.xy_leg_right = self.xy + self.size * np.array([np.cos(self.direction_rad - 2 * np.pi / 3), np.sin(self.direction_rad - 2 * np.pi / 3)], dtype=np.float64)
+        self.x_leg_right, self.y_leg_right = self.points_polygon(4, self.size * 0.2, self.xy_leg_right, self.direction_rad)
         self.leg_right.set_xy(np.column_stack((self.x_leg_right, self.y_leg_right)))
 
-        self.xy_leg_left = self.xy + self.size * np.array([np.cos(float(self.direction) + 2 * np.pi / 3), np.sin(float(self.direction) + 2 * np.pi / 3)], dtype=np.float64)
-        self.x_leg_left, self.y_leg_left = self.points_polygon(4, self.size * 0.2, self.xy_leg_left, self.direction)
+        self.xy_leg_left = self.xy + self.size * np.array([np.cos(self.direction_rad + 2 * np.pi / 3), np.sin(self.direction_rad + 2 * np.pi / 3)], dtype=np.float64)
+        self.x_leg_left, self.y_leg_left = self.points_polygon(4, self.size * 0.2, self.xy_leg_left, self.direction_rad)
         self.leg_left.set_xy(np.column_stack((self.x_leg_left, self.y_leg_left)))
 
-        self.path.set_data(np.array(self.x_path, dtype=np.float64), np.array(self.y_path, dtype=np.float64))
-
-    def pendown(self):
-        self.is_pen_down = True
-        self.x_path.append(self.xy[0])
-        self.y_path.append(self.xy[1])
-
-    def penup(self):
-        self.is_pen_down = False
-
-    def forward(self, distance):
-        self.xy += float(distance) * np.array([np.cos(float(self.direction)), np.sin(float(self.direction))], dtype=np.float64)
-
-        if self.is_pen_down:
-            self.x_path.append(self.xy[0])
-            self.y_path.append(self.xy[1])
+        if self.swarm_xy is not None:
+            self.swarm.set_data(self.swarm_xy[:, 0], self.swarm_xy[:, 1])
         else:
-            self.x_path.append(None)
-            self.y_path.append(None)
-
-        self.update_draw()
-
-    def right(self, angle_deg):
-        self.direction -= Decimal(np.deg2rad(float(angle_deg)))
-        self.update_draw()
-
-    def left(self, angle_deg):
-        self.direction += Decimal(np.deg2rad(float(angle_deg)))
-        self.update_draw()
-
-    def reset(self):
-        self.direction = Decimal(np.deg2rad(float(0.)))
-        self.xy = np.array([0., 0.], dtype=np.float64)
-        self.x_path = []
-        self.y_path = []
-        self.update_draw()
+            self.swarm.set_data([], [])
+
+        self.update_lod()
+
+    def update_lod(self):
+        """ Decimate the new path vertices for the current transform, all of them after a zoom, resize or reset.
+        Only the scale matters, so panning keeps the decimation """
+        linear = self.ax.transData.get_matrix()[:2, :2]
+        if self.linear_lod is None or not np.array_equal(linear, self.linear_lod):
+            self.linear_lod = linear.copy()
+            self.path_lod = PathBuffer(2)
+            self.i_lod = 0
+            self.cell_lod = None
+            for chunk in self.chunks:
+                chunk.remove()
+            self.chunks = []
+            self.i_frozen = 0
+        path_xy = self.path_xy.view()
+        if len(path_xy) > self.i_lod:
+            points = path_xy[self.i_lod:]
+            cells = np.floor(points @ (linear.T / size_cell_lod))  # NaN gaps never match, so they are kept
+            is_kept = np.empty(len(cells), dtype=bool)
+            is_kept[0] = self.cell_lod is None or np.any(cells[0] != self.cell_lod)
+            is_kept[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+            self.path_lod.extend(points[is_kept])
+            self.cell_lod = cells[-1]
+            self.i_lod = len(path_xy)
+            self.freeze_chunks()
+        path_lod = self.path_lod.view()[self.i_frozen:]
+        self.path.set_data(path_lod[:, 0], path_lod[:, 1])
+
+    def freeze_chunks(self):
+        """ Move full chunks of the decimated path into lines of their own, which are never set again,
+        so a redraw only rebuilds the path of the last chunk """
+        path_lod = self.path_lod.view()
+        while len(path_lod) - self.i_frozen > size_chunk:
+            chunk = path_lod[self.i_frozen:self.i_frozen + size_chunk]
+            gaps = np.flatnonzero(np.isnan(chunk[:, 0]))
+            if len(gaps) > 0 and gaps[-1] > 0:
+                chunk = chunk[:gaps[-1]]
+                i_next = self.i_frozen + gaps[-1] + 1  # The gap separates the lines
+            else:
+                i_next = self.i_frozen + size_chunk - 1  # The last vertex starts the next line
+            line, = self.ax.plot(chunk[:, 0].copy(), chunk[:, 1].copy(), color=self.path.get_color())
+            self.chunks.append(line)
+            self.i_frozen = i_next
+
+    def on_limits_changed(self, ax):
+        """ Zoom from the toolbar: decimate again before the canvas is redrawn """
+        self.update_lod()
+
+    def on_resize(self, event):
+        """ The axes box of an equal aspect is only adjusted while drawing, apply it now for the new transform """
+        self.ax.apply_aspect()
+        self.update_lod()
+
+    def draw_animated(self):
+        if self.swarm_xy is not None:
+            self.ax.draw_artist(self.swarm)
+        self.ax.draw_artist(self.body)
+        self.ax.draw_artist(self.head)
+        self.ax.draw_artist(self.arm_right)
+        self.ax.draw_artist(self.arm_left)
+        self.ax.draw_artist(self.leg_right)
+        self.ax.draw_artist(self.leg_left)
+
+    def draw_stroke(self):
+        """ Draw the path vertices added since the last commit, return True if anything was drawn """
+        if len(self.path_xy) <= self.i_committed:
+            return False
+        path_xy = self.path_xy.view()[max(self.i_committed - 1, 0):]
+        self.stroke.set_data(path_xy[:, 0], path_xy[:, 1])
+        self.ax.draw_artist(self.stroke)
+        self.i_committed = len(self.path_xy)
+        return True
+
+    def commit_stroke(self):
+        """ Mark the whole path as drawn in the background """
+        self.i_committed = len(self.path_xy)
+        self.is_path_cleared = False
+
+
+""" Opcodes of compiled programs """
+OP_SET = 0
+OP_PENUP = 1
+OP_PENDOWN = 2
+OP_FORWARD = 3
+OP_RIGHT = 4
+OP_LEFT = 5
+OP_ADD = 6
+OP_LOOP = 7     # Enter a repeat block: operand (loop slot, count, pc after the block)
+OP_NEXT = 8     # End of a repeat block: operand (loop slot, pc of the first command in the block)
+OP_RESET = 9
+OP_LOOP_PURE = 10  # OP_LOOP of a block with only forward/right/left: operand (loop slot, count, pc after the block, block)
+OP_SPAWN = 11   # Operand (count, spread in degrees)
+OP_CALL = 12    # Call a subroutine: operand its pc
+OP_RETURN = 13  # Back after the last call, or to the end of the program outside a call
+OP_PUSH = 14
+OP_POP = 15
+OP_UNKNOWN = 16
+
+opcodes = {
+    "set": OP_SET,
+    "penup": OP_PENUP,
+    "pendown": OP_PENDOWN,
+    "forward": OP_FORWARD,
+    "right": OP_RIGHT,
+    "left": OP_LEFT,
+    "add": OP_ADD,
+    "reset": OP_RESET,
+    "spawn": OP_SPAWN,
+    "push": OP_PUSH,
+    "pop": OP_POP,
+}
+opcode_names = {op: name for name, op in opcodes.items()}
+opcode_names.update({OP_LOOP: "repeat", OP_NEXT: "]", OP_LOOP_PURE: "repeat (batch)",
+                     OP_CALL: "call", OP_RETURN: "return", OP_UNKNOWN: "unknown"})
+
+arities = {  # Command -> (min, max) number of arguments, to split a line into its commands
+    "set": (2, 2),
+    "penup": (0, 0),
+    "pendown": (0, 0),
+    "forward": (1, 1),
+    "right": (1, 1),
+    "left": (1, 1),
+    "add": (2, 2),
+    "reset": (0, 0),
+    "spawn": (1, 2),
+    "push": (0, 0),
+    "pop": (0, 0),
+    "repeat": (1, 1),
+}
+
+pattern_token = re.compile(r"\[|\]|#.*|[^\s\[\]#]+")  # Bracket, comment to the end of the line or word
+pattern_number = re.compile(r"-?(\d+\.?\d*|\.\d+)$")
+
+
+class Command(tuple):
+    """ Node of a program: tuple (command, *args), repeat is ("repeat", count, [commands]).
+    Attributes line and column are its position in the source, starting at 1 """
+
+
+class LSystem:
+    """ L-system: an axiom rewritten depth times by the rules, then drawn with the commands of each symbol.
+    Default commands: F G forward step, f move without drawing, + - turn left / right by angle, | turn around, [ ] push / pop.
+    Other symbols draw nothing unless mapped """
+    def __init__(self, axiom="", rules=None, depth=0, angle=90, step=10):
+        self.axiom = axiom
+        self.rules = rules if rules is not None else {}  # Symbol -> successor
+        self.depth = depth
+        self.angle = angle
+        self.step = step
+        self.mapping = {}  # Symbol -> commands replacing its default ones
+
+    def load(self, lines):
+        """ Read directives, one per line, with comments after #:
+        axiom F--F--F, rule F F+F--F+F, depth 4, angle 60, step 5, map X forward 5; left 30 """
+        for i_line, line in enumerate(lines, 1):
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            directive, args = words[0], words[1:]
+            if directive == "axiom":
+                self.axiom = "".join(args)
+            elif directive == "rule" and args and len(args[0]) == 1:
+                self.rules[args[0]] = "".join(args[1:])
+            elif directive == "depth" and len(args) == 1 and args[0].isdigit():
+                self.depth = int(args[0])
+            elif directive in ("angle", "step") and len(args) == 1 and pattern_number.match(args[0]):
+                setattr(self, directive, float(args[0]) if "." in args[0] else int(args[0]))
+            elif directive == "map" and args and len(args[0]) == 1:
+                commands = []
+                for words_command in " ".join(args[1:]).split(";"):
+                    if words_command.split():
+                        command = Command(words_command.split())
+                        command.line = i_line
+                        command.column = 1
+                        commands.append(command)
+                self.mapping[args[0]] = commands
+            else:
+                raise SyntaxError(f"Invalid L-system directive at line {i_line}: {line.strip()}")
+
+    def commands(self, symbol):
+        """ Commands drawn for a symbol that is not rewritten any further """
+        if symbol in self.mapping:
+            return self.mapping[symbol]
+        angle, step = str(self.angle), str(self.step)
+        defaults = {
+            "F": [("forward", step)],
+            "G": [("forward", step)],
+            "f": [("penup",), ("forward", step), ("pendown",)],
+            "+": [("left", angle)],
+            "-": [("right", angle)],
+            "|": [("left", "180")],
+            "[": [("push",)],
+            "]": [("pop",)],
+        }
+        return defaults.get(symbol, [])
 
 
 class Interpreter:
     def __init__(self):
         self.variables = {}  # Global variables
-        self.commands = []   # Commands
+        self.source = None   # Generator of the top-level commands not parsed yet
+        self.cache_key = None  # Key to cache the program with once it is parsed
+        self.parse_complete = False  # The source was parsed to its end without error
+        self.num_steps = 0     # Steps executed since the start of the program
+        self.interval_keyframes = 1000  # Steps between keyframes
+        self.max_keyframes = 256        # Every other keyframe is dropped and the interval doubled beyond this
+        self.clear_keyframes()
+        self.code = []       # Compiled program (flat list of (opcode, operand))
         self.pc = 0          # Program counter
-        self.context_stack = []  # State management stack for repeat blocks
+        self.loop_counts = []      # Repeat count of each loop slot
+        self.loop_iterations = []  # Current iteration of each loop slot
+        self.is_fast = False       # Execute pure repeat blocks in one batch (no animation)
+        self.call_stack = []       # Return pc of each subroutine being executed
+
+        # Dispatch table indexed by opcode
+        self.dispatch = [
+            self.op_set,
+            self.op_penup,
+            self.op_pendown,
+            self.op_forward,
+            self.op_right,
+            self.op_left,
+            self.op_add,
+            self.op_loop,
+            self.op_next,
+            self.op_reset,
+            self.op_loop_pure,
+            self.op_spawn,
+            self.op_call,
+            self.op_return,
+            self.op_push,
+            self.op_pop,
+            self.op_unknown,
+        ]
+        self.dispatch_plain = self.dispatch
+        self.undo_log = None  # Ring buffer of (pc, loop slot, variable, turtle snapshot, call stack) before each step
+        self.set_profiling(False)
 
     def set_variable(self, name, value):
         self.variables[name] = int(value)
-        print(f"Set variable {name} = {value}")
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, f"Set variable {name} = {value}")
 
     def get_variable(self, name):
         if name not in self.variables:
             raise NameError(f"Variable '{name}' is not defined")
         return self.variables[name]
 
-    def get_value(self, value):
-        """Determine if the input is a variable name or a literal number and return its value."""
+    def operand(self, value):
+        """Pre-resolve an argument: a literal number becomes int or float, a variable name stays str."""
         if value.isdigit():
-            return int(value)  # Return the integer if it's a number
-        elif value in self.variables:
-            return self.get_variable(value)  # Return the value of the variable
+            return int(value)
+        if pattern_number.match(value):
+            return float(value) if "." in value else int(value)
+        return value
+
+    def resolve(self, operand):
+        """Return the value of a pre-resolved operand."""
+        if operand.__class__ is not str:
+            return operand
+        try:
+            return self.variables[operand]
+        except KeyError:
+            raise ValueError(f"Invalid value or undefined variable: '{operand}'") from None
+
+    def compile_next(self):
+        """ Parse and compile the next top-level command, return False at the end of the source """
+        try:
+            command = next(self.source, None) if self.source is not None else None
+            if command is not None:
+                self.compile_commands([command])
+                return True
+        except Exception:
+            # The rest of the program is lost, it must not be cached
+            self.source = None
+            self.cache_key = None
+            raise
+        if self.parse_complete and self.cache_key is not None:
+            program_cache.put(self.cache_key, self.compiled())
+        self.source = None
+        self.cache_key = None
+        return False
+
+    def compile_commands(self, commands):
+        """ Append top-level commands to the program """
+        num_loops = self.compile_block(commands, self.code, len(self.loop_counts))
+        self.loop_counts.extend([0] * (num_loops - len(self.loop_counts)))
+        self.loop_iterations.extend([0] * (num_loops - len(self.loop_iterations)))
+
+    def compile_block(self, commands, code, num_loops):
+        """ Append the instructions of a block to code and return the number of loop slots in use """
+        for command, *args in commands:
+            if command == "repeat":
+                slot = num_loops
+                num_loops += 1
+                i_loop = len(code)
+                code.append(None)  # Patched once the end of the block is known
+                num_loops = self.compile_block(args[1], code, num_loops)
+                code.append((OP_NEXT, (slot, i_loop + 1)))
+                if self.is_pure_block(args[1]):
+                    code[i_loop] = (OP_LOOP_PURE, (slot, self.operand(args[0]), len(code), args[1]))
+                else:
+                    code[i_loop] = (OP_LOOP, (slot, self.operand(args[0]), len(code)))
+            elif command == "set":
+                code.append((OP_SET, (args[0], args[1])))
+            elif command == "add":
+                code.append((OP_ADD, (args[0], self.operand(args[1]))))
+            elif command == "spawn":
+                code.append((OP_SPAWN, (self.operand(args[0]), self.operand(args[1]) if len(args) > 1 else 360)))
+            elif command in opcodes:
+                code.append((opcodes[command], self.operand(args[0]) if args else None))
+            else:
+                code.append((OP_UNKNOWN, command))
+        return num_loops
+
+    def load_lsystem(self, lsystem):
+        """ Compile an L-system without expanding its string: the axiom is the main program and the successor
+        of a symbol at each generation is a subroutine, called by the generation before it.
+        The code grows with depth times the size of the rules and the call stack with depth """
+        self.source = None
+        self.cache_key = None
+        self.code = []
+        subroutines = {}  # (symbol, generation) -> pc
+        calls = []        # Calls to patch: (pc of the call, symbol, generation)
+        self.code.append((OP_PENDOWN, None))  # The pen of a new turtle is up
+        num_loops = self.compile_symbols(lsystem, lsystem.axiom, 0, calls, 0)
+        self.code.append((OP_RETURN, None))
+        while calls:
+            pc, symbol, generation = calls.pop()
+            if (symbol, generation) not in subroutines:
+                subroutines[(symbol, generation)] = len(self.code)
+                num_loops = self.compile_symbols(lsystem, lsystem.rules[symbol], generation, calls, num_loops)
+                self.code.append((OP_RETURN, None))
+            self.code[pc] = (OP_CALL, subroutines[(symbol, generation)])
+        self.loop_counts = [0] * num_loops
+        self.loop_iterations = [0] * num_loops
+        self.profile_blocks = {}
+
+    def compile_symbols(self, lsystem, symbols, generation, calls, num_loops):
+        """ Append the commands of the symbols of a generation, a call for each symbol rewritten further """
+        for symbol in symbols:
+            if symbol in lsystem.rules and generation < lsystem.depth:
+                calls.append((len(self.code), symbol, generation + 1))
+                self.code.append(None)  # Patched once the subroutine is compiled
+            else:
+                num_loops = self.compile_block(lsystem.commands(symbol), self.code, num_loops)
+        return num_loops
+
+    def is_pure_block(self, commands):
+        """ True if a block contains only forward/right/left and nested blocks of them """
+        for command, *args in commands:
+            if command == "repeat":
+                if not self.is_pure_block(args[1]):
+                    return False
+            elif command not in ("forward", "right", "left"):
+                return False
+        return len(commands) > 0
+
+    def unroll(self, commands):
+        """ Return heading changes, distances and forward flags of a pure block executed once,
+        and the exact sum of its heading changes """
+        angles, distances, is_move = [], [], []
+        turn = 0
+        for command, *args in commands:
+            value = self.resolve(self.operand(args[0]))
+            if command == "repeat":
+                block_angles, block_distances, block_is_move, block_turn = self.unroll(args[1])
+                angles.append(np.tile(block_angles, value))
+                distances.append(np.tile(block_distances, value))
+                is_move.append(np.tile(block_is_move, value))
+                turn += value * block_turn
+            elif command == "forward":
+                angles.append([0])
+                distances.append([float(value)])
+                is_move.append([True])
+            else:
+                angle = -value if command == "right" else value
+                angles.append([angle])
+                distances.append([0.])
+                is_move.append([False])
+                turn += angle if angle.__class__ is int else Fraction(angle)
+        return (np.concatenate(angles).astype(np.float64), np.concatenate(distances).astype(np.float64),
+                np.concatenate(is_move).astype(bool), turn)
+
+    def count_moves(self, commands):
+        """ Return the number of turns and moves of a pure block executed once, without unrolling it """
+        num_moves = 0
+        for command, *args in commands:
+            if command == "repeat":
+                num_moves += self.resolve(self.operand(args[0])) * self.count_moves(args[1])
+            else:
+                num_moves += 1
+        return num_moves
+
+    def count_steps(self, commands):
+        """ Return the number of steps of a block executed once step by step:
+        one per command, and for a repeat block one for its loop and one per iteration for its next """
+        num_steps = 0
+        for command, *args in commands:
+            num_steps += 1
+            if command == "repeat":
+                count = self.resolve(self.operand(args[0]))
+                if count > 0:
+                    num_steps += count * (self.count_steps(args[1]) + 1)
+        return num_steps
+
+    def op_set(self, operand):
+        name, value = operand
+        self.set_variable(name, value)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"set {name} {value}")
+
+    def op_penup(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "penup")
+        my_turtle.penup()
+
+    def op_pendown(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "pendown")
+        my_turtle.pendown()
+
+    def op_forward(self, operand):
+        steps = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"forward {steps}")
+        my_turtle.forward(steps)
+
+    def op_right(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"right {angle}")
+        my_turtle.right(angle)
+
+    def op_left(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"left {angle}")
+        my_turtle.left(angle)
+
+    def op_add(self, operand):
+        var_name, increment = operand
+        increment = self.resolve(increment)
+        self.variables[var_name] += increment
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"add {var_name} {increment}")
+
+    def op_loop(self, operand):
+        slot, count, end_pc = operand
+        count = self.resolve(count)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"repeat {count}")
+        if count > 0:
+            self.loop_counts[slot] = count
+            self.loop_iterations[slot] = 0
         else:
-            raise ValueError(f"Invalid value or undefined variable: '{value}'")
-
-    def execute_command(self, command, *args):
-        """ Execute commands """
-        if command == "set":
-            self.set_variable(args[0], args[1])
-            print(f"set {args[0]} {args[1]}")
-        elif command == "penup":
-            print(f"penup")
-            my_turtle.penup()
-        elif command == "pendown":
-            print(f"pendown")
-            my_turtle.pendown()
-        elif command == "forward":
-            steps = self.get_value(args[0])
-            print(f"forward {steps}")
-            my_turtle.forward(steps)
-        elif command == "right":
-            angle = self.get_value(args[0])
-            print(f"right {angle}")
-            my_turtle.right(angle)
-        elif command == "left":
-            angle = self.get_value(args[0])
-            print(f"left {angle}")
-            my_turtle.left(angle)
-        elif command == "add":
-            var_name = args[0]
-            increment = self.get_value(args[1])
-            self.variables[var_name] += increment
-            print(f"add {var_name} {increment}")
-        elif command == "repeat":
-            count = self.get_value(args[0])
-            block_commands = args[1]
-            self.context_stack.append({
-                "commands": block_commands,
-                "count": count,
-                "iteration": 0,
-                "index": 0
-            })
-            print(f"repeat {count}")
-        elif command == "reset":
-            print(f"reset")
-            my_turtle.reset()
+            self.pc = end_pc
+
+    def op_next(self, operand):
+        slot, body_pc = operand
+        self.loop_iterations[slot] += 1
+        if self.loop_iterations[slot] < self.loop_counts[slot]:
+            # Continue repeat block
+            self.pc = body_pc
+            if trace.level >= TRACE_DEBUG:
+                trace.write(TRACE_DEBUG, f"Repeat iteration {self.loop_iterations[slot]} of {self.loop_counts[slot]}")
         else:
-            print(f"Unknown command: {command}")
+            # Finish repeat block
+            if trace.level >= TRACE_DEBUG:
+                trace.write(TRACE_DEBUG, "End repeat block")
+
+    def op_loop_pure(self, operand):
+        slot, count, end_pc, commands = operand
+        if not self.is_fast:
+            self.op_loop((slot, count, end_pc))
+            return
+        num_moves = self.count_moves(commands)
+        if num_moves > moves_batch:
+            self.op_loop((slot, count, end_pc))  # Iterate, the pure blocks inside are batched
+            return
+        count = self.resolve(count)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"repeat {count}")
+        if count > 0:
+            angles, distances, is_move, turn = self.unroll(commands)
+            iterations = max(1, moves_batch // max(1, num_moves))
+            for start in range(0, count, iterations):
+                n = min(iterations, count - start)
+                my_turtle.move_batch(np.tile(angles, n), np.tile(distances, n), np.tile(is_move, n), n * turn)
+            # Count the steps the block takes step by step, which seek replays, besides this one
+            self.num_steps += count * (self.count_steps(commands) + 1)
+            if self.undo_log is not None:
+                self.undo_log.clear()  # Step back replays from a keyframe instead
+        self.pc = end_pc
+
+    def op_reset(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "reset")
+        my_turtle.reset()
+
+    def op_spawn(self, operand):
+        count, spread = operand
+        count, spread = self.resolve(count), self.resolve(spread)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"spawn {count} {spread}")
+        my_turtle.spawn(count, spread)
+
+    def op_push(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "push")
+        my_turtle.push()
+
+    def op_pop(self, operand):
+        if my_turtle.depth_stack == 0:
+            if trace.level >= TRACE_SUMMARY:
+                trace.write(TRACE_SUMMARY, "Pop with an empty stack")
+            return
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "pop")
+        my_turtle.pop()
+
+    def op_call(self, operand):
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, f"Call {operand}")
+        self.call_stack.append(self.pc)
+        self.pc = operand
+
+    def op_return(self, operand):
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, "Return")
+        self.pc = self.call_stack.pop() if self.call_stack else len(self.code)
+
+    def op_unknown(self, operand):
+        if trace.level >= TRACE_SUMMARY:
+            trace.write(TRACE_SUMMARY, f"Unknown command: {operand}")
 
     def step(self):
-        if self.context_stack:
-            # Process the current context
-            current_context = self.context_stack[-1]
-            commands = current_context["commands"]
-            index = current_context["index"]
-            iteration = current_context["iteration"]
-            count = current_context["count"]
-
-            if index < len(commands):
-                # Execute commands in current block
-                command, *args = commands[index]
-                self.execute_command(command, *args)
-                current_context["index"] += 1
+        pc = self.pc
+        if pc < len(self.code) or self.compile_next():
+            if self.num_steps >= self.step_keyframe:  # A batched block passes several steps at once
+                self.save_keyframe()
+            # Fetch and dispatch one instruction
+            op, operand = self.code[pc]
+            self.pc = pc + 1
+            self.dispatch[op](operand)
+            self.num_steps += 1
+            return True  # Continue program
+        if trace.level >= TRACE_SUMMARY:
+            trace.write(TRACE_SUMMARY, "Program finished")
+        return False  # Finish program
+
+    def run(self, max_steps, time_budget=None, op_stop=None):
+        """ Execute up to max_steps instructions or until time_budget (sec) is spent or the next instruction is op_stop,
+        return the number of executed steps (all those of a batched block) and whether the program continues """
+        deadline = time.perf_counter() + time_budget if time_budget else None
+        num_steps_start = self.num_steps
+        num_instructions = 0
+        while num_instructions < max_steps:
+            if op_stop is not None and self.next_op() == op_stop:
+                break
+            if not self.step():
+                return self.num_steps - num_steps_start, False
+            num_instructions += 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        return self.num_steps - num_steps_start, True
+
+    def next_op(self):
+        """ Opcode of the next instruction, None at the end of the program """
+        if self.pc < len(self.code) or self.compile_next():
+            return self.code[self.pc][0]
+        return None
+
+    def clear_keyframes(self):
+        self.keyframes = []       # (step, pc, loop counts, loop iterations, variables, turtle snapshot)
+        self.steps_keyframes = []  # Step of each keyframe, ascending
+        self.spacing_keyframes = self.interval_keyframes
+        self.step_keyframe = 0    # Step to save the next keyframe at
+
+    def save_keyframe(self):
+        """ Snapshot the state before step num_steps is executed """
+        num_steps = self.num_steps
+        self.step_keyframe = num_steps + self.spacing_keyframes
+        if self.steps_keyframes and num_steps <= self.steps_keyframes[-1]:
+            return  # Replaying steps after a seek
+        self.keyframes.append((num_steps, self.pc, list(self.loop_counts), list(self.loop_iterations),
+                               dict(self.variables), my_turtle.snapshot(), tuple(self.call_stack)))
+        self.steps_keyframes.append(num_steps)
+        if len(self.keyframes) > self.max_keyframes:
+            self.keyframes = self.keyframes[::2]
+            self.steps_keyframes = self.steps_keyframes[::2]
+            self.spacing_keyframes *= 2
+
+    def seek(self, num_steps):
+        """ Go to the state after num_steps steps, replaying only the steps after the nearest keyframe.
+        Return the number of steps reached and whether the program continues """
+        i = bisect.bisect_right(self.steps_keyframes, num_steps) - 1
+        if i >= 0 and not self.steps_keyframes[i] <= self.num_steps <= num_steps:
+            step, self.pc, loop_counts, loop_iterations, variables, turtle, call_stack = self.keyframes[i]
+            self.call_stack = list(call_stack)
+            self.num_steps = step
+            self.step_keyframe = step
+            self.loop_counts[:len(loop_counts)] = loop_counts
+            self.loop_iterations[:len(loop_iterations)] = loop_iterations
+            self.variables = dict(variables)
+            my_turtle.restore(turtle)
+            if self.undo_log is not None:
+                self.undo_log.clear()
+        while self.num_steps < num_steps:
+            if not self.step():
+                return self.num_steps, False
+        return self.num_steps, True
+
+    def set_profiling(self, is_profiling, pre_hook=None, post_hook=None):
+        """ Count calls and time of each opcode and iterations of each repeat block.
+        When off, the dispatch table holds the plain handlers and nothing is measured.
+        pre_hook(interpreter, pc, op, operand) and post_hook(interpreter, pc, op, operand, ns) run around each command """
+        self.is_profiling = is_profiling
+        self.pre_hook = pre_hook
+        self.post_hook = post_hook
+        self.profile_calls = [0] * len(self.dispatch_plain)
+        self.profile_ns = [0] * len(self.dispatch_plain)
+        self.profile_blocks = {}    # pc of repeat -> [entries, iterations]
+        self.profile_sections = {}  # Section of a frame -> [calls, ns]
+        self.build_dispatch()
+
+    def build_dispatch(self):
+        """ Wrap the plain handlers for the undo log and profiling, as enabled """
+        dispatch = self.dispatch_plain
+        if self.undo_log is not None:
+            dispatch = [self.recorded(op, handler) for op, handler in enumerate(dispatch)]
+        if self.is_profiling:
+            dispatch = [self.profiled(op, handler) for op, handler in enumerate(dispatch)]
+        self.dispatch = dispatch
+
+    def set_undo(self, num_steps):
+        """ Keep what the last num_steps steps changed to step back, 0 disables it """
+        self.undo_log = deque(maxlen=num_steps) if num_steps > 0 else None
+        self.build_dispatch()
+
+    def recorded(self, op, handler):
+        """ Handler of op that first pushes the state it changes to the undo log """
+        undo_log = self.undo_log
+        if op in (OP_LOOP, OP_NEXT, OP_LOOP_PURE):
+            def handler_recorded(operand):
+                slot = operand[0]
+                undo_log.append((self.pc - 1, (slot, self.loop_counts[slot], self.loop_iterations[slot]), None, None, None))
+                handler(operand)
+        elif op == OP_SET or op == OP_ADD:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, (operand[0], self.variables.get(operand[0])), None, None))
+                handler(operand)
+        elif op == OP_CALL or op == OP_RETURN:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, None, None, tuple(self.call_stack)))
+                handler(operand)
+        else:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, None, my_turtle.snapshot(), None))
+                handler(operand)
+        return handler_recorded
+
+    def step_back(self):
+        """ Undo the last step, from the undo log or else from a keyframe. Return False at the start """
+        if not self.undo_log:
+            if self.num_steps == 0:
+                return False
+            self.seek(self.num_steps - 1)
+            return True
+        self.pc, loop, variable, turtle, call_stack = self.undo_log.pop()
+        if loop is not None:
+            slot, self.loop_counts[slot], self.loop_iterations[slot] = loop
+        if variable is not None:
+            name, value = variable
+            if value is None:
+                del self.variables[name]
             else:
-                # Continue repeat block
-                current_context["iteration"] += 1
-                if current_context["iteration"] < count:
-                    current_context["index"] = 0
-                    print(f"Repeat iteration {current_context['iteration']} of {count}")
+                self.variables[name] = value
+        if turtle is not None:
+            my_turtle.restore(turtle)
+        if call_stack is not None:
+            self.call_stack = list(call_stack)
+        self.num_steps -= 1
+        return True
+
+    def profiled(self, op, handler):
+        """ Handler of op wrapped with counters and hooks """
+        def handler_profiled(operand):
+            pc = self.pc - 1
+            if self.pre_hook is not None:
+                self.pre_hook(self, pc, op, operand)
+            time_start = time.perf_counter_ns()
+            handler(operand)
+            ns = time.perf_counter_ns() - time_start
+            self.profile_calls[op] += 1
+            self.profile_ns[op] += ns
+            if op == OP_LOOP or op == OP_LOOP_PURE:
+                block = self.profile_blocks.setdefault(pc, [0, 0])
+                block[0] += 1
+                if op == OP_LOOP_PURE and self.pc == operand[2]:  # Batched, the iterations skipped OP_NEXT
+                    block[1] += self.resolve(operand[1])
+            elif op == OP_NEXT:
+                self.profile_blocks.setdefault(operand[1] - 1, [0, 0])[1] += 1
+            if self.post_hook is not None:
+                self.post_hook(self, pc, op, operand, ns)
+        return handler_profiled
+
+    def profile_section(self, name, ns):
+        """ Add the time of a section outside the interpreter, e.g. update_draw or canvas draw """
+        section = self.profile_sections.setdefault(name, [0, 0])
+        section[0] += 1
+        section[1] += ns
+
+    def profile_report(self):
+        lines = ["Opcode          calls    total ms    ns/call"]
+        for op in sorted(range(len(self.profile_calls)), key=lambda op: -self.profile_ns[op]):
+            calls, ns = self.profile_calls[op], self.profile_ns[op]
+            if calls:
+                lines.append(f"{opcode_names[op]:14s} {calls:6d} {ns / 1e6:11.3f} {ns / calls:10.0f}")
+        if self.profile_blocks:
+            lines.append("Repeat block    entries  iterations")
+            for pc, (entries, iterations) in sorted(self.profile_blocks.items()):
+                lines.append(f"pc {pc:<11d} {entries:8d} {iterations:11d}")
+        if self.profile_sections:
+            lines.append("Section         calls    total ms    ns/call")
+            for name, (calls, ns) in self.profile_sections.items():
+                lines.append(f"{name:14s} {calls:6d} {ns / 1e6:11.3f} {ns / calls:10.0f}")
+        return "\n".join(lines)
+
+    def parse(self, lines):
+        """ Yield the top-level commands of an iterable of lines, each one at the end of its last line.
+        A line holds several commands, each one taking the number of arguments in arities,
+        and an unknown one the words up to the next known command """
+        blocks = []  # Open repeat blocks: (count, commands, line, column)
+        for i_line, line in enumerate(lines, 1):
+            if "[" not in line and "]" not in line and "#" not in line:
+                words = line.split()
+                if not words:
+                    continue
+                if len(words) - 1 <= arities.get(words[0], (0, -1))[1]:
+                    # Fast path: one command
+                    if words[0] == "repeat":
+                        raise SyntaxError(f"Repeat block must start with '[' at line {i_line}")
+                    command = Command(words)
+                    command.line = i_line
+                    command.column = len(line) - len(line.lstrip()) + 1
+                    if blocks:
+                        blocks[-1][1].append(command)
+                    else:
+                        yield command
+                    continue
+
+            words = []
+            columns = []
+            for match in pattern_token.finditer(line):
+                token = match.group()
+                if token[0] == "#":
+                    break
+                if token == "[":
+                    commands = self.split_words(words, columns)
+                    if not commands or commands[-1][0][0] != "repeat" or len(commands[-1][0]) != 2:
+                        raise SyntaxError(f"Unexpected '[' at line {i_line}, column {match.start() + 1}")
+                    for command in self.parse_commands(commands[:-1], i_line, blocks):
+                        yield command
+                    (_, count), column = commands[-1]
+                    blocks.append((count, [], i_line, column))
+                    words = []
+                    columns = []
+                elif token == "]":
+                    for command in self.parse_commands(self.split_words(words, columns), i_line, blocks):
+                        yield command
+                    words = []
+                    columns = []
+                    if not blocks:
+                        raise SyntaxError(f"Unexpected ']' at line {i_line}, column {match.start() + 1}")
+                    count, block, line_repeat, column_repeat = blocks.pop()
+                    for command in self.parse_words(["repeat", count, block], line_repeat, column_repeat, blocks):
+                        yield command
                 else:
-                    # Finish repeat block
-                    self.context_stack.pop()
-                    print("End repeat block")
-        elif self.pc < len(self.commands):
-            # Execute global commands
-            command, *args = self.commands[self.pc]
-            self.pc += 1
-            self.execute_command(command, *args)
-        else:
-            print("Program finished")
-            return False  # Finish program
-        return True  # Continue program
-
-    def parse_block(self, lines, start_index):
-        """ parse repeat block """
+                    words.append(token)
+                    columns.append(match.start() + 1)
+            for command in self.parse_commands(self.split_words(words, columns), i_line, blocks):
+                yield command
+        if blocks:
+            raise SyntaxError(f"No closing ']' found for the repeat block at line {blocks[-1][2]}, column {blocks[-1][3]}")
+        self.parse_complete = True
+
+    def split_words(self, words, columns):
+        """ Split the words of a line into the words of each command, return a list of (words, column) """
         commands = []
-        i = start_index
-        while i < len(lines):
-            line = lines[i].strip()
-            if line == "]":
-                return commands, i
-            parts = line.split()
-            command = parts[0]
-            if command == "repeat":
-                block_var = parts[1]
-                if parts[2] != "[":
-                    raise SyntaxError("Repeat block must start with '['")
-                nested_commands, new_index = self.parse_block(lines, i + 1)
-                commands.append((command, block_var, nested_commands))
-                i = new_index
-            else:
-                commands.append((command, *parts[1:]))
-            i += 1
-        raise SyntaxError("No closing ']' found for a repeat block")
-
-    def load_program(self, lines):
         i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if not line or line.startswith("#"):
-                i += 1
-                continue
+        while i < len(words):
+            min_args, max_args = arities.get(words[i], (0, len(words)))
+            end = min(i + 1 + min_args, len(words))
+            while end < min(i + 1 + max_args, len(words)) and words[end] not in arities:
+                end += 1
+            commands.append((words[i:end], columns[i]))
+            i = end
+        return commands
+
+    def parse_commands(self, commands, line, blocks):
+        """ Add the commands split from a line, a repeat needs its '[' on the same line """
+        for words, column in commands:
+            if words[0] == "repeat":
+                raise SyntaxError(f"Repeat block must start with '[' at line {line}, column {column}")
+            for command in self.parse_words(words, line, column, blocks):
+                yield command
+
+    def parse_words(self, words, line, column, blocks):
+        """ Add a command to the innermost open block, or yield it at the top level """
+        command = Command(words)
+        command.line = line
+        command.column = column
+        if blocks:
+            blocks[-1][1].append(command)
+        else:
+            yield command
+
+    def stream_program(self, lines, cache_key=None):
+        """ Start a program from an iterable of lines (a file, a generator, ...),
+        the top-level commands are parsed and compiled as execution reaches them.
+        With cache_key, the compiled program goes to program_cache at the end of the source """
+        self.source = self.parse(lines)
+        self.cache_key = cache_key
+        self.parse_complete = False
+        self.profile_blocks = {}
+
+    def compiled(self):
+        """ Program to cache: (code, number of loop slots), the commands are only kept in the operands that need them """
+        return list(self.code), len(self.loop_counts)
+
+    def load_compiled(self, program):
+        code, num_loops = program
+        self.code = list(code)
+        self.loop_counts = [0] * num_loops
+        self.loop_iterations = [0] * num_loops
+        self.source = None
+        self.cache_key = None
+        self.profile_blocks = {}
 
-            parts = line.split()
-            command = parts[0]
-            if command == "repeat":
-                block_var = parts[1]
-                if parts[2] != "[":
-                    raise SyntaxError("Repeat block must start with '['")
-                block_commands, new_index = self.parse_block(lines, i + 1)
-                self.commands.append((command, block_var, block_commands))
-                i = new_index
-            else:
-                self.commands.append((command, *parts[1:]))
-            i += 1
+    def load_program(self, lines):
+        """ Parse and compile a whole program """
+        self.profile_blocks = {}
+        self.compile_commands(list(self.parse(lines)))
 
     def reset(self):
         self.pc = 0
-        self.context_stack = []
+        self.num_steps = 0
+        self.call_stack = []
+        self.clear_keyframes()
+        if self.undo_log is not None:
+            self.undo_log.clear()
+        self.loop_counts = [0] * len(self.loop_counts)
+        self.loop_iterations = [0] * len(self.loop_iterations)
 
     def clear(self):
         self.pc = 0
-        self.context_stack = []
-        self.commands = []
+        self.num_steps = 0
+        self.call_stack = []
+        self.clear_keyframes()
+        if self.undo_log is not None:
+            self.undo_log.clear()
+        self.source = None
+        self.cache_key = None
+        self.code = []
+        self.loop_counts = []
+        self.loop_iterations = []
+
+
+class Engine:
+    """ Run the interpreter on a worker thread, one frame of steps at a time.
+    The turtle events of each frame go to the Tk thread through a bounded queue,
+    the worker waits while it is full instead of running ahead of the view """
+    def __init__(self, interpreter, turtle, view, max_frames=8):
+        self.interpreter = interpreter
+        self.turtle = turtle
+        self.view = view
+        self.frames = queue.Queue(maxsize=max_frames)  # (turtle events, steps, steps since the start, is_run, error)
+        self.lock = threading.Lock()  # Held while the interpreter and the turtle are used
+        self.is_play = threading.Event()  # The worker runs frames while set
+        self.is_run = True  # The program continues as of the last frame, no frames after its end
+        self.max_steps = 1
+        self.time_budget = None
+        view.events = deque()  # The turtle's queue belongs to the worker, the view gets the events of taken frames
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            self.is_play.wait()
+            with self.lock:
+                if not self.is_play.is_set() or not self.is_run:
+                    self.is_play.clear()
+                    continue
+                num_steps_start = self.interpreter.num_steps
+                error = None
+                try:
+                    num_steps, self.is_run = self.interpreter.run(self.max_steps, self.time_budget)
+                except Exception as e:
+                    # Ends the program, not the worker, the error goes to the Tk thread with the frame
+                    num_steps, self.is_run = self.interpreter.num_steps - num_steps_start, False
+                    error = e
+                events, self.turtle.events = self.turtle.events, deque()
+                trace.flush()
+                # Waits while the Tk thread is behind, it drains the queue before taking the lock
+                self.frames.put((events, num_steps, self.interpreter.num_steps, self.is_run, error))
+
+    def next_frame(self):
+        """ Hand the events of the next frame to the view, return (steps, steps since the start, is_run)
+        or None if the worker has not finished one. An error of the program is reported here """
+        try:
+            events, num_steps, num_steps_total, is_run, error = self.frames.get_nowait()
+        except queue.Empty:
+            return None
+        self.view.events.extend(events)
+        if error is not None:
+            print(f"Error while running program: {error}")
+        return num_steps, num_steps_total, is_run
+
+    def drain(self):
+        """ Hand the events of all queued frames to the view, return their number of steps """
+        num_steps = 0
+        frame = self.next_frame()
+        while frame is not None:
+            num_steps += frame[0]
+            frame = self.next_frame()
+        return num_steps
+
+    def acquire(self):
+        """ Pause the worker and take the interpreter for a command of the Tk thread,
+        return the number of steps of the frames the worker had queued """
+        self.is_play.clear()
+        num_steps = 0
+        while not self.lock.acquire(timeout=0.005):
+            num_steps += self.drain()  # Lets a worker waiting to put a frame finish it
+        return num_steps + self.drain()
+
+    def release(self):
+        """ Hand the events of the Tk thread's command to the view and give the interpreter back """
+        self.view.events.extend(self.turtle.events)
+        self.turtle.events.clear()
+        self.is_run = True
+        trace.flush()
+        self.lock.release()
+
+
+def create_window():
+    """ Embed in Tkinter, imported here so that rendering without GUI works where Tk is not installed """
+    global root, canvas, toolbar, tk, ttk
+    import tkinter as tk
+    from tkinter import ttk
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    root = tk.Tk()
+    root.title(title_tk)
+    canvas = FigureCanvasTkAgg(fig, root)
+    canvas.get_tk_widget().pack(expand=True, fill="both")
+
+    toolbar = NavigationToolbar2Tk(canvas, root)
+    canvas.get_tk_widget().pack()
+
+
+def render_file(filename, output, is_profiling=False):
+    """ Run a command file to the end without Tkinter and save the final figure """
+    global canvas, interpreter, my_turtle, my_turtle_view
+    canvas = FigureCanvasAgg(fig)
+    interpreter = Interpreter()
+    interpreter.set_profiling(is_profiling)
+    interpreter.is_fast = True
+    my_turtle = Turtle(xy=np.array([0, 0]), direction=0)
+    my_turtle_view = TurtleView(ax=ax0, turtle=my_turtle, size=size_turtle, color="green")
+
+    time_start = time.perf_counter_ns()
+    load_file(filename)
+    is_running = True
+    while is_running:
+        _, is_running = interpreter.run(10000)
+        my_turtle_view.consume_events()
+    time_run = time.perf_counter_ns()
+
+    my_turtle_view.update_draw()
+    time_update_draw = time.perf_counter_ns()
+    fig.savefig(output)
+    trace.flush()
+    if is_profiling:
+        interpreter.profile_section("run", time_run - time_start)
+        interpreter.profile_section("update_draw", time_update_draw - time_run)
+        interpreter.profile_section("savefig", time.perf_counter_ns() - time_update_draw)
+        print(interpreter.profile_report())
+
+
+def load_file(filename):
+    """ Load a command file into the interpreter, parsing it only if its content is not in program_cache.
+    An .lsys file is an L-system, compiled into subroutines """
+    if os.path.splitext(filename)[1] == ".lsys":
+        lsystem = LSystem()
+        with open(filename) as f:
+            lsystem.load(f)
+        interpreter.load_lsystem(lsystem)
+        return
+    with open(filename, "rb") as f:
+        key = program_cache.key(f)
+    program = program_cache.get(key)
+    if program is not None:
+        interpreter.load_compiled(program)
+    else:
+        interpreter.stream_program(read_lines(filename), cache_key=key)
+
+
+def read_lines(filename):
+    """ Lines of a text file, which stays open only until the last one is read """
+    with open(filename) as f:
+        yield from f
 
 
 def execute_file(filename):
-    global is_run, is_play
-    interpreter.clear()
+    global is_run, is_play, is_fast_forward
+    is_fast_forward = False
+    acquire_interpreter()
     try:
-        with open(filename) as f:
-            lines = f.readlines()
+        interpreter.clear()
+        my_turtle.forget_path()  # The keyframes are cleared
+        load_file(filename)
     except FileNotFoundError:
-        pass
         print(f"Error: File '{filename}' not found.")
+        return
     except Exception as e:
         print(f"Error while processing file: {e}")
+        return
+    finally:
+        release_interpreter()
 
-    interpreter.load_program(lines)
     is_play = True
     is_run = True
 
@@ -382,10 +1725,53 @@ def create_animation_control():
     frm_anim.pack(side="left", fill=tk.Y)
     btn_play = tk.Button(frm_anim, text="Play/Pause", command=switch)
     btn_play.pack(side="left")
+    btn_back = tk.Button(frm_anim, text="Step back", command=step_back)
+    btn_back.pack(side="left")
+    btn_end = tk.Button(frm_anim, text="Run to end", command=run_to_end)
+    btn_end.pack(side="left")
+    btn_next_reset = tk.Button(frm_anim, text="Run to reset", command=lambda: run_to_end(OP_RESET))
+    btn_next_reset.pack(side="left")
     btn_reset = tk.Button(frm_anim, text="Reset", command=reset)
     btn_reset.pack(side="left")
 
 
+def create_speed_control():
+    global var_steps, var_budget
+    frm_speed = ttk.Labelframe(root, relief="ridge", text="Speed", labelanchor="n")
+    frm_speed.pack(side="left", fill=tk.Y)
+
+    lbl_steps = tk.Label(frm_speed, text="Steps/frame:")
+    lbl_steps.pack(side="left")
+    var_steps = tk.StringVar(root)
+    var_steps.set(str(steps_per_frame))
+    spn_steps = tk.Spinbox(
+        frm_speed, textvariable=var_steps, format="%.0f", from_=1, to=100000, increment=1, width=6,
+        command=set_speed
+    )
+    spn_steps.bind("<Return>", lambda event: set_speed())
+    spn_steps.pack(side="left")
+
+    lbl_budget = tk.Label(frm_speed, text="ms/frame (0: off):")
+    lbl_budget.pack(side="left")
+    var_budget = tk.StringVar(root)
+    var_budget.set(str(budget_ms_per_frame))
+    spn_budget = tk.Spinbox(
+        frm_speed, textvariable=var_budget, format="%.0f", from_=0, to=1000, increment=10, width=5,
+        command=set_speed
+    )
+    spn_budget.bind("<Return>", lambda event: set_speed())
+    spn_budget.pack(side="left")
+
+
+def set_speed():
+    global steps_per_frame, budget_ms_per_frame
+    try:
+        steps_per_frame = max(1, int(float(var_steps.get())))
+        budget_ms_per_frame = max(0., float(var_budget.get()))
+    except ValueError:
+        pass
+
+
 def create_file_name_setter():
     frm_fn = ttk.Labelframe(root, relief="ridge", text="File name", labelanchor="n")
     frm_fn.pack(side='left')
@@ -396,38 +1782,220 @@ def create_file_name_setter():
 
 
 def reset():
-    global is_play, is_run
+    global is_play, is_run, is_fast_forward
+    is_fast_forward = False
     is_play = False
     is_run = False
+    acquire_interpreter()
     interpreter.reset()
     cnt.reset()
     my_turtle.reset()
+    my_turtle.forget_path()  # The keyframes are cleared
+    release_interpreter()
+
+
+def create_seek_control():
+    global scl_seek
+    frm_seek = ttk.Labelframe(root, relief="ridge", text="Seek", labelanchor="n")
+    frm_seek.pack(side="left", fill=tk.Y)
+    scl_seek = tk.Scale(frm_seek, orient="horizontal", from_=0, to=0, length=160)
+    scl_seek.bind("<ButtonRelease-1>", lambda event: seek(scl_seek.get()))
+    scl_seek.pack(side="left")
+
+
+def seek(num_steps):
+    global is_run, is_fast_forward
+    is_fast_forward = False
+    acquire_interpreter()
+    try:
+        num_steps, is_run = interpreter.seek(num_steps)
+    except Exception as e:
+        print(f"Error while running program: {e}")
+        num_steps, is_run = interpreter.num_steps, False
+    finally:
+        release_interpreter()
+    cnt.reset()
+    cnt.count_up(num_steps)
+
+
+def step_back():
+    global is_play, is_run, is_fast_forward
+    is_fast_forward = False
+    is_play = False
+    acquire_interpreter()
+    if interpreter.step_back():
+        is_run = True
+        cnt.reset()
+        cnt.count_up(interpreter.num_steps)
+        scl_seek.set(interpreter.num_steps)
+    release_interpreter()
 
 
 def switch():
-    global is_play
+    global is_play, is_fast_forward
+    is_fast_forward = False
     is_play = not is_play
 
 
-def update(f):
-    global is_run
-    if not is_play:
+def run_to_end(op_stop=None):
+    """ Run the program without drawing frames, then draw once.
+    With op_stop (OP_RESET), stop before the next instruction with this opcode instead of the end """
+    global is_fast_forward, is_run
+    if is_fast_forward or not is_run:
         return
+    acquire_interpreter()
+    if op_stop is not None and interpreter.next_op() == op_stop:
+        num_steps, is_run = run_program(1)  # Pass the one the last run stopped at
+        cnt.count_up(num_steps)
+    release_interpreter()
     if not is_run:
         return
-    cnt.count_up()
-    if not interpreter.step():
-        is_run = False
+    is_fast_forward = True
+    root.after_idle(run_chunk, op_stop)
 
 
-""" main loop """
-if __name__ == "__main__":
-    create_animation_control()
-    create_file_name_setter()
-    cnt = Counter(ax=ax0, is3d=False, xy=np.array([x_min, y_max]), label="Step=")
+def run_chunk(op_stop):
+    """ One chunk of run_to_end, the next one is scheduled after Tkinter has handled its events """
+    global is_fast_forward, is_run, is_play
+    if not is_fast_forward:
+        return  # Cancelled
+    acquire_interpreter()
+    interpreter.is_fast = True  # Pure repeat blocks in one batch, only for the chunks of this run
+    try:
+        num_steps, is_run = run_program(steps_fast_forward, op_stop=op_stop)
+    finally:
+        interpreter.is_fast = False
+        release_interpreter()
+    cnt.count_up(num_steps)
+    my_turtle_view.consume_events()  # Keep the event queue short, the path is drawn once at the end
+    trace.flush()
+    if is_run and num_steps >= steps_fast_forward:
+        root.after(1, run_chunk, op_stop)
+        return
+    is_fast_forward = False
+    is_play = False
+    if interpreter.num_steps > scl_seek.cget("to"):
+        scl_seek.configure(to=interpreter.num_steps)
+    scl_seek.set(interpreter.num_steps)
+    my_turtle_view.update_draw()
+    blit_manager.background = None  # Draw everything in one full redraw instead of a blitted stroke
+    canvas.draw_idle()
+
+
+def run_program(max_steps, time_budget=None, op_stop=None):
+    """ Interpreter.run for the Tk thread: the file is parsed as it runs,
+    an error in it is reported and ends the program instead of the timer callback """
+    num_steps_start = interpreter.num_steps
+    try:
+        return interpreter.run(max_steps, time_budget, op_stop)
+    except Exception as e:
+        print(f"Error while running program: {e}")
+        return interpreter.num_steps - num_steps_start, False
+
+
+def acquire_interpreter():
+    """ Take the interpreter from the worker thread of the engine, if any, for a command of the Tk thread """
+    if engine is not None:
+        cnt.count_up(engine.acquire())
+
+
+def release_interpreter():
+    if engine is not None:
+        engine.release()
 
-    interpreter = Interpreter()
-    my_turtle = Turtle(ax=ax0, xy=np.array([0, 0]), direction=0, size=size_turtle, color="green")
 
-    anim = animation.FuncAnimation(fig, update, interval=100, save_count=100)
-    root.mainloop()
+def max_steps_frame():
+    """ Step cap of a frame: steps_per_frame, or none when a ms budget decides how much runs """
+    return steps_per_frame if budget_ms_per_frame == 0 else sys.maxsize
+
+
+def update_engine():
+    """ Take one frame of steps from the engine, whose worker runs ahead while playing """
+    global is_run
+    engine.max_steps = max_steps_frame()
+    engine.time_budget = budget_ms_per_frame / 1000.
+    if not (is_play and is_run):
+        engine.is_play.clear()
+        return
+    engine.is_play.set()
+    frame = engine.next_frame()
+    if frame is not None:
+        num_steps, num_steps_total, is_run = frame
+        cnt.count_up(num_steps)
+        if num_steps_total > scl_seek.cget("to"):
+            scl_seek.configure(to=num_steps_total)
+        scl_seek.set(num_steps_total)
+
+
+def update():
+    global is_run
+    if is_fast_forward:
+        return
+    time_start = time.perf_counter_ns()
+    if engine is not None:
+        update_engine()
+    elif is_play and is_run:
+        num_steps, is_run = run_program(max_steps_frame(), budget_ms_per_frame / 1000.)
+        cnt.count_up(num_steps)
+        if interpreter.num_steps > scl_seek.cget("to"):
+            scl_seek.configure(to=interpreter.num_steps)
+        scl_seek.set(interpreter.num_steps)
+    time_run = time.perf_counter_ns()
+    my_turtle_view.update_draw()
+    time_update_draw = time.perf_counter_ns()
+    blit_manager.update()
+    if engine is None:
+        trace.flush()  # The worker flushes its own trace
+    if interpreter.is_profiling:
+        interpreter.profile_section("run", time_run - time_start)
+        interpreter.profile_section("update_draw", time_update_draw - time_run)
+        interpreter.profile_section("blit", time.perf_counter_ns() - time_update_draw)
+
+
+""" main loop """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=title_tk)
+    parser.add_argument("--render", metavar="FILE", help="run a command file to the end without GUI and save the figure")
+    parser.add_argument("-o", "--output", help="output image file (.png, .svg, ...), default: FILE with .png")
+    parser.add_argument("--trace", choices=["off", "summary", "command", "debug"], default="command", help="trace level of executed commands")
+    parser.add_argument("--cache-dir", metavar="DIR", help="also keep compiled programs in this directory")
+    parser.add_argument("--keyframe-interval", type=int, default=1000, metavar="K", help="steps between keyframes for seeking")
+    parser.add_argument("--max-keyframes", type=int, default=256, metavar="N", help="max number of keyframes, the interval doubles beyond it")
+    parser.add_argument("--undo-steps", type=int, default=10000, metavar="N", help="steps kept to step back in O(1), older ones go through keyframes")
+    parser.add_argument("--profile", action="store_true", help="print calls and time of each command, repeat block and frame section")
+    parser.add_argument("--trace-sample", type=int, default=1, metavar="N", help="trace every N-th command")
+    parser.add_argument("--thread", action="store_true", help="run the interpreter on a worker thread, the timer only draws")
+    args = parser.parse_args()
+    trace.level = ["off", "summary", "command", "debug"].index(args.trace)
+    trace.sample = args.trace_sample
+    program_cache.directory = args.cache_dir
+
+    if args.render:
+        render_file(args.render, args.output or os.path.splitext(args.render)[0] + ".png", args.profile)
+    else:
+        create_window()
+        create_animation_control()
+        create_speed_control()
+        create_seek_control()
+        create_file_name_setter()
+        cnt = Counter(ax=ax0, is3d=False, xy=np.array([x_min, y_max]), label="Step=")
+
+        interpreter = Interpreter()
+        interpreter.set_profiling(args.profile)
+        interpreter.interval_keyframes = args.keyframe_interval
+        interpreter.max_keyframes = args.max_keyframes
+        interpreter.clear_keyframes()
+        interpreter.set_undo(args.undo_steps)
+        my_turtle = Turtle(xy=np.array([0, 0]), direction=0)
+        my_turtle_view = TurtleView(ax=ax0, turtle=my_turtle, size=size_turtle, color="green")
+        if args.thread:
+            engine = Engine(interpreter, my_turtle, my_turtle_view)
+
+        blit_manager = BlitManager(canvas, artists=[cnt.txt_step], views=[my_turtle_view])
+        timer = canvas.new_timer(interval=100)
+        timer.add_callback(update)
+        timer.start()
+        root.mainloop()
+        trace.flush()
+        if args.profile:
+            print(interpreter.profile_report())
@@ -16,16 +16,23 @@ repeat 50 [
 ]
 """
 
+import argparse
+import bisect
+import hashlib
+import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 from matplotlib.figure import Figure
-import matplotlib.animation as animation
 import numpy as np
-import tkinter as tk
-from tkinter import ttk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import proj3d
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 import mpl_toolkits.mplot3d.art3d as art3d
-from scipy.spatial.transform import Rotation
 
 from decimal import Decimal, getcontext
 getcontext().prec = 50
@@ -34,11 +41,25 @@ getcontext().prec = 50
 """ Global variables """
 command_counter = 0
 size_turtle = 5
+size_stack = 64  # Rows preallocated for the push / pop stack of a turtle, doubled when full
+version_compiler = 5  # Bump when the parser or the opcodes change to invalidate cached programs
 commands = []
 expanded_commands = []
 variables = {}
 
+""" Trace levels """
+TRACE_OFF = 0       # Silent
+TRACE_SUMMARY = 1   # End of programs and unknown commands
+TRACE_COMMAND = 2   # Every executed command
+TRACE_DEBUG = 3     # Variables and repeat iterations
+
 """ Animation control """
+steps_per_frame = 1         # Max interpreter steps per animation frame
+budget_ms_per_frame = 0.    # Time budget of interpreter steps per animation frame (0: no limit)
+steps_fast_forward = 10000  # Steps per chunk of a run to the end, Tkinter handles its events between chunks
+is_fast_forward = False     # Running to the end, frames are not drawn
+engine = None               # Engine running the interpreter on a worker thread, None to run it in the animation timer
+speed_forward = 50.         # Speed of animated forward moves (units/sec)
 is_play = False
 is_run = False
 
@@ -47,6 +68,11 @@ vector_x_axis = np.array([1., 0., 0.])
 vector_y_axis = np.array([0., 1., 0.])
 vector_z_axis = np.array([0., 0., 1.])
 
+""" Orientation """
+rotations_plane = {}                # Angle in degrees -> 2x2 rotation of the two axes perpendicular to the turning axis
+size_rotations_plane = 1024         # Max number of cached angles
+num_turns_orthonormalize = 64       # Re-orthonormalize the turtle's frame after this many turns
+
 """ Create figure and axes """
 title_ax0 = "Turtle graphics 3D"
 title_tk = title_ax0
@@ -70,20 +96,107 @@ ax0.set_xlim(x_min, x_max)
 ax0.set_ylim(y_min, y_max)
 ax0.set_zlim(z_min, z_max)
 
-""" Embed in Tkinter """
-root = tk.Tk()
-root.title(title_tk)
-canvas = FigureCanvasTkAgg(fig, root)
-canvas.get_tk_widget().pack(expand=True, fill="both")
-
-toolbar = NavigationToolbar2Tk(canvas, root)
-canvas.get_tk_widget().pack()
-
 """ Global objects of Tkinter """
+var_steps = None
+var_budget = None
+root = None
+canvas = None
+toolbar = None
+scl_seek = None
 
 """ Classes and functions """
 
 
+class Trace:
+    """ Leveled trace messages, buffered and optionally sampled """
+    def __init__(self, level=TRACE_COMMAND, sample=1, size_buffer=256):
+        self.level = level
+        self.sample = sample            # Write every sample-th message of command and debug levels
+        self.size_buffer = size_buffer  # Flush when this many lines are buffered
+        self.buffer = []
+        self.num_messages = 0
+
+    def write(self, level, message):
+        """ Buffer a message, the caller checks self.level first to skip formatting it """
+        if level > TRACE_SUMMARY and self.sample > 1:
+            self.num_messages += 1
+            if self.num_messages % self.sample:
+                return
+        self.buffer.append(message)
+        if len(self.buffer) >= self.size_buffer:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            sys.stdout.write("\n".join(self.buffer) + "\n")
+            sys.stdout.flush()
+            self.buffer = []
+
+
+trace = Trace()
+
+
+class ProgramUnpickler(pickle.Unpickler):
+    """ Load cached programs, Command is the only class allowed whichever module pickled it """
+    def find_class(self, module, name):
+        if name == "Command":
+            return Command
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a cached program")
+
+
+class ProgramCache:
+    """ Compiled programs by content hash, in memory (LRU) and optionally as pickle files in a directory """
+    def __init__(self, size=16, directory=None):
+        self.size = size
+        self.directory = directory
+        self.programs = OrderedDict()
+
+    def key(self, f):
+        """ Hash of the content of a binary file, read in chunks, and of the compiler """
+        digest = hashlib.sha256(f"{os.path.basename(__file__)} {version_compiler}\n".encode())
+        for chunk in iter(lambda: f.read(size_chunk_hash), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key):
+        program = self.programs.get(key)
+        if program is not None:
+            self.programs.move_to_end(key)
+            return program
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, key + ".pickle"), "rb") as f:
+                program = ProgramUnpickler(f).load()
+        except Exception:
+            return None  # Missing or unreadable, parse again
+        self.remember(key, program)
+        return program
+
+    def put(self, key, program):
+        self.remember(key, program)
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, key + ".pickle")
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(program, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Error while saving compiled program: {e}")
+
+    def remember(self, key, program):
+        self.programs[key] = program
+        self.programs.move_to_end(key)
+        while len(self.programs) > self.size:
+            self.programs.popitem(last=False)
+
+
+program_cache = ProgramCache()
+size_chunk_hash = 1 << 20  # Bytes of a command file read at once to hash it
+
+
 class Counter:
     def __init__(self, is3d=None, ax=None, xy=None, z=None, label=""):
         self.is3d = is3d if is3d is not None else False
@@ -101,8 +214,8 @@ class Counter:
             self.xz, self.yz, _ = proj3d.proj_transform(self.x, self.y, self.z, self.ax.get_proj())
             self.txt_step.set_position((self.xz, self.yz))
 
-    def count_up(self):
-        self.count += 1
+    def count_up(self, num=1):
+        self.count += num
         self.txt_step.set_text(self.label + str(self.count))
 
     def reset(self):
@@ -113,357 +226,1445 @@ class Counter:
         return self.count
 
 
-class Turtle3d:
-    def __init__(self, ax=None, xyz=None, direction=None, size=None, color=None):
-        self.ax = ax
-        self.xyz = np.array(xyz, dtype=np.float64)
-        self.direction = Decimal(direction)
-        self.size = size
-        self.color = color
+class PathBuffer:
+    """ Growable float64 array of path vertices, a row of NaN separates strokes (pen up) """
+    def __init__(self, dim, capacity=1024):
+        self.data = np.empty((capacity, dim), dtype=np.float64)
+        self.capacity = capacity
+        self.size = 0
+        self.start = 0  # First vertex of the path, cleared vertices before it are kept for seeking back
+        self.size_max = 0  # Vertices after size up to here are kept for seeking forward, as of the last seek
 
-        self.roll_axis = np.array([1., 0., 0.])
-        self.pitch_axis = np.array([0., 1., 0.])
-        self.yaw_axis = np.array([0., 0., 1.])
+    def __len__(self):
+        return self.size - self.start
 
-        self.body_vertices = [[self.pitch_axis * -10. + self.xyz,
-                               self.roll_axis * 10. + self.xyz,
-                               self.pitch_axis * 10. + self.xyz]]
-        self.body = Poly3DCollection(self.body_vertices, facecolors=self.color, linewidths=1, edgecolors=self.color, alpha=.25)
-        self.ax.add_collection3d(self.body)
+    def grow(self):
+        data = np.empty((2 * len(self.data), self.data.shape[1]), dtype=np.float64)
+        size = max(self.size, self.size_max)
+        data[:size] = self.data[:size]
+        self.data = data
 
-        self.x_path = []
-        self.y_path = []
-        self.z_path = []
-        self.path, = self.ax.plot(np.array(self.x_path, dtype=np.float64),
-                                  np.array(self.y_path, dtype=np.float64),
-                                  np.array(self.z_path, dtype=np.float64))
+    def extend(self, points):
+        while self.size + len(points) > len(self.data):
+            self.grow()
+        self.data[self.size:self.size + len(points)] = points
+        self.size += len(points)
 
-        self.is_pen_down = False
+    def clear(self):
+        self.start = self.size
+
+    def drop(self, count):
+        """ Free the first count vertices once nothing seeks back to them, positions count from the next one """
+        size = self.size - count
+        data = np.empty((max(self.capacity, 2 * size), self.data.shape[1]), dtype=np.float64)
+        data[:size] = self.data[count:self.size]
+        self.data = data
+        self.size = size
+        self.start = max(self.start - count, 0)
+        self.size_max = 0
+
+    def seek(self, start, size):
+        """ Restore the path of a keyframe, start and size count the vertices appended since creation.
+        Replaying a program appends the same vertices again, so the ones after a keyframe stay valid """
+        self.size_max = max(self.size, self.size_max)
+        self.size = min(size, self.size_max)
+        self.start = min(start, self.size)
+
+    def view(self):
+        """ Return the stored vertices without copying, one row per vertex """
+        return self.data[self.start:self.size]
+
+
+class BlitManager:
+    """ Redraw only the animated artists over a cached background, new path segments are committed into it """
+    def __init__(self, canvas, artists=(), views=()):
+        self.canvas = canvas
+        self.background = None
+        self.artists = []
+        self.views = []
+        for artist in artists:
+            self.add_artist(artist)
+        for view in views:
+            self.add_view(view)
+        self.cid = self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+    def add_view(self, view):
+        self.views.append(view)
+
+    def on_draw(self, event):
+        """ Cache the background after a full redraw (start, resize, zoom, reset) """
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        for view in self.views:
+            view.commit_stroke()
+        self.draw_animated()
+
+    def draw_animated(self):
+        for view in self.views:
+            view.draw_animated()
+        for artist in self.artists:
+            self.canvas.figure.draw_artist(artist)
+
+    def update(self):
+        if self.background is None or any(view.is_path_cleared for view in self.views):
+            # The cached background is stale, wait for a full redraw
+            self.background = None
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        if any([view.draw_stroke() for view in self.views]):
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+
+
+def rotation_plane(angle):
+    """ Rotation matrix of the (j, k) rows of a frame turned by angle (deg) around its i-th row, cached """
+    rotation = rotations_plane.get(angle)
+    if rotation is None:
+        if angle % 90 == 0:
+            c, s = ((1., 0.), (0., 1.), (-1., 0.), (0., -1.))[int(angle % 360 // 90)]
+        else:
+            c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+        rotation = np.array([[c, s], [-s, c]])
+        if len(rotations_plane) < size_rotations_plane:
+            rotations_plane[angle] = rotation
+    return rotation
 
-    def pendown(self):
-        print("pendown")
-        self.is_pen_down = True
 
-        self.x_path.append(self.xyz[0])
-        self.y_path.append(self.xyz[1])
-        self.z_path.append(self.xyz[2])
+""" Turtle events """
+EV_MOVE = 0     # Moved forward: data (x, y, z) after the move
+EV_TURN = 1     # Orientation changed: data (roll axis, pitch axis)
+EV_PEN = 2      # Pen state changed: data is_pen_down
+EV_RESET = 3    # Back to the origin with an empty path: data None
+EV_MOVE_STEP = 4    # Moved forward, animated from the previous position: data (x, y, z) after the move
+EV_SEEK = 5     # State restored from a keyframe: data Turtle3d.snapshot()
+EV_SWARM = 6    # Turtles of a swarm moved: data (positions before or None, positions after or None without a swarm)
+EV_JUMP = 7     # Popped a state: data (x, y, z), frame, is_pen_down and whether a gap starts on the path
+EV_FORGET = 8   # Path before the last reset dropped: data number of vertices dropped
 
-        self.body.set_facecolor(self.color)
-        self.body.set_edgecolor(self.color)
 
-    def penup(self):
-        print("penup")
+class Turtle3d:
+    """ Pose and pen of a 3D turtle, every change is queued in self.events for the view """
+    def __init__(self, xyz=None, direction=None):
+        self.xyz = np.array(xyz, dtype=np.float64)
+        self.direction = Decimal(direction)
+
+        self.frame = np.eye(3)     # Rows: roll, pitch and yaw axes
+        self.num_turns = 0
+
         self.is_pen_down = False
+        self.num_vertices = 0  # Vertices appended to the view's path and first one after the last reset, for keyframes
+        self.start_path = 0
+        self.events = deque()
 
-        self.body.set_facecolor("gray")
-        self.body.set_edgecolor("gray")
+        # Swarm of turtles spawned from this one, structure of arrays with one row per turtle, turtle 0 is this one.
+        # Arrays are replaced, never changed in place, so snapshots and events can keep them
+        self.swarm_xyz = None     # Positions
+        self.swarm_frames = None  # Frames, rows roll, pitch and yaw axes as in self.frame
 
-    def forward(self, distance):
-        print(f"forward {distance}")
-        normalized_vector = self.roll_axis / np.linalg.norm(self.roll_axis)
-        self.xyz = self.xyz + normalized_vector * float(distance)
-
-        if self.is_pen_down:
-            self.x_path.append(self.xyz[0])
-            self.y_path.append(self.xyz[1])
-            self.z_path.append(self.xyz[2])
-        else:
-            self.x_path.append(None)
-            self.y_path.append(None)
-            self.z_path.append(None)
+        # States saved by push, one row each: x, y, z, frame (9) and is_pen_down
+        self.stack = np.empty((size_stack, 13), dtype=np.float64)
+        self.depth_stack = 0
+        self.is_gap = False  # The path ends with the gap of a jump, the position is appended once drawing resumes
 
-        self.update_draw()
+    @property
+    def roll_axis(self):
+        return self.frame[0]
 
-    def forward_step(self, distance):
-        print(f"forward {distance}")
-        d = 0
-        step = 0.2
-        while d + step <= distance:
-            normalized_vector = self.roll_axis / np.linalg.norm(self.roll_axis)
-            self.xyz = self.xyz + normalized_vector * float(step)
+    @property
+    def pitch_axis(self):
+        return self.frame[1]
 
-            if self.is_pen_down:
-                self.x_path.append(self.xyz[0])
-                self.y_path.append(self.xyz[1])
-                self.z_path.append(self.xyz[2])
-            else:
-                self.x_path.append(None)
-                self.y_path.append(None)
-                self.z_path.append(None)
+    @property
+    def yaw_axis(self):
+        return self.frame[2]
 
-            self.update_draw()
-            d += step
+    def pendown(self):
+        self.is_pen_down = True
+        self.is_gap = False
+        self.num_vertices += 1
+        self.events.append((EV_PEN, True))
 
-        remaining_distance = distance - d
-        if remaining_distance > 0:
-            normalized_vector = self.roll_axis / np.linalg.norm(self.roll_axis)
-            self.xyz = self.xyz + normalized_vector * float(remaining_distance)
+    def penup(self):
+        self.is_pen_down = False
+        self.events.append((EV_PEN, False))
 
-            if self.is_pen_down:
-                self.x_path.append(self.xyz[0])
-                self.y_path.append(self.xyz[1])
-                self.z_path.append(self.xyz[2])
-            else:
-                self.x_path.append(None)
-                self.y_path.append(None)
-                self.z_path.append(None)
+    def forward(self, distance):
+        if self.swarm_xyz is not None:
+            self.forward_swarm(distance)
+            return
+        if self.is_gap and self.is_pen_down:
+            self.pendown()  # Start of the path after a jump
+        self.xyz = self.xyz + self.frame[0] * float(distance)
+        self.num_vertices += 1
+        self.events.append((EV_MOVE, self.xyz))
 
-            self.update_draw()
+    def forward_step(self, distance):
+        if self.swarm_xyz is not None:
+            self.forward_swarm(distance)  # Not animated
+            return
+        if self.is_gap and self.is_pen_down:
+            self.pendown()  # Start of the path after a jump
+        self.xyz = self.xyz + self.frame[0] * float(distance)
+        self.num_vertices += 1
+        self.events.append((EV_MOVE_STEP, self.xyz))
 
     def right(self, angle):
-        print(f"right {angle}")
         self.yaw(- angle)
 
     def left(self, angle):
-        print(f"left {angle}")
         self.yaw(angle)
 
     def up(self, angle):
-        print(f"up {angle}")
         self.pitch(- angle)
 
     def down(self, angle):
-        print(f"down {angle}")
         self.pitch(angle)
 
     def roll_cw(self, angle):
-        print(f"roll_cw {angle}")
         self.roll(angle)
 
     def roll_ccw(self, angle):
-        print(f"roll_ccw {angle}")
         self.roll(- angle)
 
     def roll(self, angle):
-        self.roll_axis = self.roll_axis / np.linalg.norm(self.roll_axis)
-        rot_matrix = Rotation.from_rotvec(np.deg2rad(angle) * self.roll_axis)
-        self.pitch_axis = rot_matrix.apply(self.pitch_axis)
-        self.yaw_axis = rot_matrix.apply(self.yaw_axis)
-        self.update_draw()
+        self.turn(0, angle)
 
     def pitch(self, angle):
-        self.pitch_axis = self.pitch_axis / np.linalg.norm(self.pitch_axis)
-        rot_matrix = Rotation.from_rotvec(np.deg2rad(angle) * self.pitch_axis)
-        self.roll_axis = rot_matrix.apply(self.roll_axis)
-        self.yaw_axis = rot_matrix.apply(self.yaw_axis)
-        self.update_draw()
+        self.turn(1, angle)
 
     def yaw(self, angle):
-        self.yaw_axis = self.yaw_axis / np.linalg.norm(self.yaw_axis)
-        rot_matrix = Rotation.from_rotvec(np.deg2rad(angle) * self.yaw_axis)
-        self.roll_axis = rot_matrix.apply(self.roll_axis)
-        self.pitch_axis = rot_matrix.apply(self.pitch_axis)
-        self.update_draw()
+        self.turn(2, angle)
+
+    def turn(self, i_axis, angle):
+        """ Rotate the frame by angle (deg) around its i_axis-th row, a new array for each turn as events keep the old one """
+        rows = [(i_axis + 1) % 3, (i_axis + 2) % 3]
+        frame = self.frame.copy()
+        frame[rows] = rotation_plane(angle) @ self.frame[rows]
+        self.num_turns += 1
+        if self.num_turns % num_turns_orthonormalize == 0:
+            frame[0] /= np.linalg.norm(frame[0])
+            frame[1] -= np.dot(frame[1], frame[0]) * frame[0]
+            frame[1] /= np.linalg.norm(frame[1])
+            frame[2] = np.cross(frame[0], frame[1])
+        self.frame = frame
+        if self.swarm_xyz is not None:
+            self.turn_swarm(rows, angle)
+        self.events.append((EV_TURN, (self.roll_axis, self.pitch_axis)))
+
+    def spawn(self, count, spread=360):
+        """ Turn into count turtles at the current position, yawed spread / count degrees apart.
+        Later commands move and turn all of them at once, a count of 1 goes back to a single turtle """
+        if count > 1:
+            angles = np.deg2rad(spread * np.arange(count, dtype=np.float64) / count)
+            c, s = np.cos(angles)[:, None], np.sin(angles)[:, None]
+            frames = np.empty((count, 3, 3), dtype=np.float64)
+            frames[:, 0] = c * self.frame[0] + s * self.frame[1]  # rotation_plane of each angle on the yaw axis
+            frames[:, 1] = -s * self.frame[0] + c * self.frame[1]
+            frames[:, 2] = self.frame[2]
+            frames[0] = self.frame
+            self.swarm_frames = frames
+            self.swarm_xyz = np.tile(self.xyz, (count, 1))
+            self.events.append((EV_SWARM, (None, self.swarm_xyz)))
+        elif self.swarm_xyz is not None:
+            self.end_swarm()
+            if self.is_pen_down:
+                self.is_gap = False
+                self.num_vertices += 1  # The path of the single turtle starts again at its position
+            self.events.append((EV_SWARM, (None, None)))
+
+    def end_swarm(self):
+        self.swarm_xyz = None
+        self.swarm_frames = None
+
+    def turn_swarm(self, rows, angle):
+        """ Rotate the frames of all turtles as turn() does, with one matrix product """
+        rotation = np.eye(3)
+        rotation[np.ix_(rows, rows)] = rotation_plane(angle)
+        frames = rotation @ self.swarm_frames
+        if self.num_turns % num_turns_orthonormalize == 0:
+            frames[:, 0] /= np.linalg.norm(frames[:, 0], axis=1)[:, None]
+            frames[:, 1] -= np.sum(frames[:, 1] * frames[:, 0], axis=1)[:, None] * frames[:, 0]
+            frames[:, 1] /= np.linalg.norm(frames[:, 1], axis=1)[:, None]
+            frames[:, 2] = np.cross(frames[:, 0], frames[:, 1])
+        frames[0] = self.frame
+        self.swarm_frames = frames
+
+    def forward_swarm(self, distance):
+        """ Move every turtle of the swarm, one segment each on the path """
+        start = self.swarm_xyz
+        self.swarm_xyz = start + float(distance) * self.swarm_frames[:, 0]
+        self.xyz = self.swarm_xyz[0].copy()
+        self.num_vertices += 3 * len(start) if self.is_pen_down else 1  # Start, end and gap of each segment, or one gap
+        self.events.append((EV_SWARM, (start, self.swarm_xyz)))
+
+    def push(self):
+        """ Save position, frame and pen on the stack """
+        self.reserve_stack(self.depth_stack + 1)
+        row = self.stack[self.depth_stack]
+        row[0:3] = self.xyz
+        row[3:12] = self.frame.ravel()
+        row[12] = self.is_pen_down
+        self.depth_stack += 1
+
+    def pop(self):
+        """ Jump to the last pushed state without drawing, a swarm ends first.
+        The path gets one gap for consecutive jumps, the position is appended when drawing resumes """
+        if self.swarm_xyz is not None:
+            self.spawn(1)
+        self.depth_stack -= 1
+        row = self.stack[self.depth_stack]
+        is_gap = not self.is_gap and not np.array_equal(row[0:3], self.xyz)
+        if is_gap:
+            self.num_vertices += 1
+            self.is_gap = True
+        was_pen_down = self.is_pen_down
+        self.xyz = row[0:3].copy()
+        self.frame = row[3:12].reshape(3, 3).copy()
+        self.is_pen_down = bool(row[12])
+        self.events.append((EV_JUMP, (self.xyz, self.frame, self.is_pen_down, is_gap)))
+        if self.is_pen_down and not was_pen_down and not self.is_gap:
+            self.pendown()
+
+    def reserve_stack(self, depth):
+        """ Grow the stack to hold depth states """
+        if depth > len(self.stack):
+            stack = np.empty((max(depth, 2 * len(self.stack)), self.stack.shape[1]), dtype=np.float64)
+            stack[:self.depth_stack] = self.stack[:self.depth_stack]
+            self.stack = stack
 
     def reset(self):
         self.xyz = np.array([0., 0., 0.])
-        self.roll_axis = np.array([1., 0., 0.])
-        self.pitch_axis = np.array([0., 1., 0.])
-        self.yaw_axis = np.array([0., 0., 1.])
-
-        self.x_path = []
-        self.y_path = []
-        self.z_path = []
+        self.frame = np.eye(3)
+        self.num_turns = 0
+        self.end_swarm()
+        self.depth_stack = 0
+        self.is_gap = False
+        self.start_path = self.num_vertices
+        self.events.append((EV_RESET, None))
 
-        self.update_draw()
         self.pendown()
 
-    def update_draw(self):
+    def forget_path(self):
+        """ Drop the path before the last reset, once no keyframe or undo record can go back to it """
+        if self.start_path:
+            self.events.append((EV_FORGET, self.start_path))
+            self.num_vertices -= self.start_path
+            self.start_path = 0
+
+    def snapshot(self):
+        """ State for keyframes """
+        swarm = (self.swarm_xyz, self.swarm_frames) if self.swarm_xyz is not None else None
+        return (self.xyz.copy(), self.frame, self.num_turns, self.is_pen_down, self.start_path, self.num_vertices, swarm,
+                self.stack[:self.depth_stack].copy(), self.is_gap)
+
+    def restore(self, snapshot):
+        xyz, self.frame, self.num_turns, self.is_pen_down, self.start_path, self.num_vertices, swarm, stack, self.is_gap = snapshot
+        self.xyz = xyz.copy()
+        self.reserve_stack(len(stack))
+        self.stack[:len(stack)] = stack
+        self.depth_stack = len(stack)
+        if swarm is not None:
+            self.swarm_xyz, self.swarm_frames = swarm
+        else:
+            self.end_swarm()
+        self.events.append((EV_SEEK, snapshot))
+
+
+class Turtle3dView:
+    """ Artists of a 3D turtle, updated from the turtle's events once per frame """
+    def __init__(self, ax=None, turtle=None, size=None, color=None):
+        self.ax = ax
+        self.turtle = turtle
+        self.events = turtle.events  # Queue of the turtle's events, a separate one when an Engine runs the interpreter
+        self.size = size
+        self.color = color
+
+        # Pose as of the last consumed event
+        self.xyz = turtle.xyz
+        self.roll_axis = turtle.roll_axis
+        self.pitch_axis = turtle.pitch_axis
+        self.is_pen_down = turtle.is_pen_down
+
         self.body_vertices = [[self.pitch_axis * -10. + self.xyz,
                                self.roll_axis * 10. + self.xyz,
                                self.pitch_axis * 10. + self.xyz]]
+        self.body = Poly3DCollection(self.body_vertices, facecolors=self.color, linewidths=1, edgecolors=self.color, alpha=.25, animated=True)
+        self.ax.add_collection3d(self.body)
+
+        self.path_xyz = PathBuffer(3)
+        self.path, = self.ax.plot(self.path_xyz.view()[:, 0],
+                                  self.path_xyz.view()[:, 1],
+                                  self.path_xyz.view()[:, 2])
+        self.stroke, = self.ax.plot([], [], [], color=self.path.get_color(), animated=True)
+        self.segment_line, = self.ax.plot([], [], [], color=self.path.get_color(), animated=True)
+        self.segment = None  # Animated forward move: (start, end, time started, duration)
+        self.i_segment = 0   # Index of the path vertex at the end of the animated move
+        self.i_committed = 0  # Number of path vertices already drawn in the blit background
+        self.is_path_cleared = False
+        self.swarm_xyz = None  # Positions of the turtles of a swarm
+        self.swarm, = self.ax.plot([], [], [], ".", color=self.color, markersize=2, animated=True)
+
+    def consume_events(self):
+        """ Apply the queued turtle events to the path, only the latest pose is kept """
+        events = self.events
+        is_pen_down = self.is_pen_down
+        vertices = []
+        while events:
+            kind, data = events.popleft()
+            self.segment = None  # Any later event completes the animated move
+            if kind == EV_MOVE_STEP:
+                start = np.array(self.xyz, dtype=np.float64)
+                end = np.array(data, dtype=np.float64)
+                self.segment = (start, end, time.perf_counter(), np.linalg.norm(end - start) / speed_forward)
+                self.i_segment = len(self.path_xyz) + len(vertices)
+                vertices.append(data if self.is_pen_down else (np.nan, np.nan, np.nan))
+                self.xyz = data
+            elif kind == EV_MOVE:
+                vertices.append(data if self.is_pen_down else (np.nan, np.nan, np.nan))
+                self.xyz = data
+            elif kind == EV_TURN:
+                self.roll_axis, self.pitch_axis = data
+            elif kind == EV_PEN:
+                self.is_pen_down = data
+                if data:
+                    vertices.append(self.xyz)
+            elif kind == EV_SWARM:
+                start, end = data
+                if start is not None:
+                    if self.is_pen_down:
+                        if vertices:
+                            self.path_xyz.extend(np.array(vertices, dtype=np.float64))
+                            vertices = []
+                        # One segment per turtle, all of them in a single extend
+                        segments = np.empty((len(end), 3, 3), dtype=np.float64)
+                        segments[:, 0] = start
+                        segments[:, 1] = end
+                        segments[:, 2] = np.nan
+                        self.path_xyz.extend(segments.reshape(-1, 3))
+                    else:
+                        vertices.append((np.nan, np.nan, np.nan))
+                elif end is None and self.is_pen_down:
+                    vertices.append(self.xyz)
+                if end is not None:
+                    self.xyz = end[0]
+                self.swarm_xyz = end
+            elif kind == EV_JUMP:
+                self.xyz, frame, self.is_pen_down, is_gap = data
+                if is_gap:
+                    vertices.append((np.nan, np.nan, np.nan))
+                self.roll_axis, self.pitch_axis = frame[0], frame[1]
+            elif kind == EV_SEEK:
+                if vertices:
+                    self.path_xyz.extend(np.array(vertices, dtype=np.float64))
+                    vertices = []
+                self.xyz, frame, _, self.is_pen_down, start_path, num_vertices, swarm, _, _ = data
+                self.swarm_xyz = swarm[0] if swarm is not None else None
+                self.roll_axis, self.pitch_axis = frame[0], frame[1]
+                self.path_xyz.seek(start_path, num_vertices)
+                self.i_committed = 0
+                self.is_path_cleared = True
+            elif kind == EV_FORGET:
+                if vertices:
+                    self.path_xyz.extend(np.array(vertices, dtype=np.float64))
+                    vertices = []
+                self.path_xyz.drop(data)
+            elif kind == EV_RESET:
+                if vertices:
+                    self.path_xyz.extend(np.array(vertices, dtype=np.float64))  # Kept before the start for seeking
+                    vertices = []
+                self.path_xyz.clear()
+                self.i_committed = 0
+                self.is_path_cleared = True
+                self.swarm_xyz = None
+                self.xyz = np.array([0., 0., 0.])
+                self.roll_axis = np.array([1., 0., 0.])
+                self.pitch_axis = np.array([0., 1., 0.])
+        if vertices:
+            self.path_xyz.extend(np.array(vertices, dtype=np.float64))
+
+        if self.is_pen_down != is_pen_down:
+            color = self.color if self.is_pen_down else "gray"
+            self.body.set_facecolor(color)
+            self.body.set_edgecolor(color)
+
+    def draw_animated(self):
+        if self.swarm_xyz is not None:
+            self.ax.draw_artist(self.swarm)
+        if self.segment is not None and self.is_pen_down:
+            self.ax.draw_artist(self.segment_line)
+        self.body.do_3d_projection()
+        self.ax.draw_artist(self.body)
+
+    def draw_stroke(self):
+        """ Draw the path vertices added since the last commit, return True if anything was drawn """
+        num_visible = self.num_visible()
+        if num_visible <= self.i_committed:
+            return False
+        path_xyz = self.path_xyz.view()[max(self.i_committed - 1, 0):num_visible]
+        self.stroke.set_data_3d(path_xyz[:, 0], path_xyz[:, 1], path_xyz[:, 2])
+        self.ax.draw_artist(self.stroke)
+        self.i_committed = num_visible
+        return True
+
+    def commit_stroke(self):
+        """ Mark the whole path as drawn in the background """
+        self.i_committed = self.num_visible()
+        self.is_path_cleared = False
+
+    def update_draw(self):
+        self.consume_events()
+        xyz = self.update_segment()
+
+        self.body_vertices = [[self.pitch_axis * -10. + xyz,
+                               self.roll_axis * 10. + xyz,
+                               self.pitch_axis * 10. + xyz]]
         self.body.set_verts(self.body_vertices)
 
-        self.path.set_xdata(np.array(self.x_path, dtype=np.float64))
-        self.path.set_ydata(np.array(self.y_path, dtype=np.float64))
-        self.path.set_3d_properties(np.array(self.z_path, dtype=np.float64))
+        if self.swarm_xyz is not None:
+            self.swarm.set_data_3d(self.swarm_xyz[:, 0], self.swarm_xyz[:, 1], self.swarm_xyz[:, 2])
+        else:
+            self.swarm.set_data_3d([], [], [])
+
+        path_xyz = self.path_xyz.view()[:self.num_visible()]
+        self.path.set_xdata(path_xyz[:, 0])
+        self.path.set_ydata(path_xyz[:, 1])
+        self.path.set_3d_properties(path_xyz[:, 2])
+
+    def update_segment(self):
+        """ Advance the animated forward move by the elapsed time, return the position to draw the turtle at """
+        if self.segment is None:
+            return self.xyz
+        start, end, time_start, duration = self.segment
+        progress = (time.perf_counter() - time_start) / duration if duration > 0 else 1.
+        if progress >= 1.:
+            self.segment = None
+            return self.xyz
+        xyz = start + progress * (end - start)
+        self.segment_line.set_data_3d([start[0], xyz[0]], [start[1], xyz[1]], [start[2], xyz[2]])
+        return xyz
+
+    def finish_segment(self):
+        self.segment = None
+
+    def is_moving(self):
+        return self.segment is not None
+
+    def num_visible(self):
+        """ Number of path vertices to draw, the end of an animated move appears when it is reached """
+        return self.i_segment if self.segment is not None else len(self.path_xyz)
+
+
+""" Opcodes of compiled programs """
+OP_SET = 0
+OP_PENUP = 1
+OP_PENDOWN = 2
+OP_FORWARD = 3
+OP_RIGHT = 4
+OP_LEFT = 5
+OP_ADD = 6
+OP_LOOP = 7     # Enter a repeat block: operand (loop slot, count, pc after the block)
+OP_NEXT = 8     # End of a repeat block: operand (loop slot, pc of the first command in the block)
+OP_RESET = 9
+OP_UP = 10
+OP_DOWN = 11
+OP_ROLL_CW = 12
+OP_ROLL_CCW = 13
+OP_SPAWN = 14   # Operand (count, spread in degrees)
+OP_CALL = 15    # Call a subroutine: operand its pc
+OP_RETURN = 16  # Back after the last call, or to the end of the program outside a call
+OP_PUSH = 17
+OP_POP = 18
+OP_UNKNOWN = 19
+
+opcodes = {
+    "set": OP_SET,
+    "penup": OP_PENUP,
+    "pendown": OP_PENDOWN,
+    "forward": OP_FORWARD,
+    "right": OP_RIGHT,
+    "left": OP_LEFT,
+    "add": OP_ADD,
+    "reset": OP_RESET,
+    "up": OP_UP,
+    "down": OP_DOWN,
+    "roll_cw": OP_ROLL_CW,
+    "roll_ccw": OP_ROLL_CCW,
+    "spawn": OP_SPAWN,
+    "push": OP_PUSH,
+    "pop": OP_POP,
+}
+opcode_names = {op: name for name, op in opcodes.items()}
+opcode_names.update({OP_LOOP: "repeat", OP_NEXT: "]", OP_CALL: "call", OP_RETURN: "return",
+                     OP_UNKNOWN: "unknown"})
+
+arities = {  # Command -> (min, max) number of arguments, to split a line into its commands
+    "set": (2, 2),
+    "penup": (0, 0),
+    "pendown": (0, 0),
+    "forward": (1, 1),
+    "right": (1, 1),
+    "left": (1, 1),
+    "up": (1, 1),
+    "down": (1, 1),
+    "roll_cw": (1, 1),
+    "roll_ccw": (1, 1),
+    "add": (2, 2),
+    "reset": (0, 0),
+    "spawn": (1, 2),
+    "push": (0, 0),
+    "pop": (0, 0),
+    "repeat": (1, 1),
+}
+
+pattern_token = re.compile(r"\[|\]|#.*|[^\s\[\]#]+")  # Bracket, comment to the end of the line or word
+pattern_number = re.compile(r"-?(\d+\.?\d*|\.\d+)$")
+
+
+class Command(tuple):
+    """ Node of a program: tuple (command, *args), repeat is ("repeat", count, [commands]).
+    Attributes line and column are its position in the source, starting at 1 """
+
+
+class LSystem:
+    """ L-system: an axiom rewritten depth times by the rules, then drawn with the commands of each symbol.
+    Default commands: F G forward step, f move without drawing, + - turn left / right by angle, | turn around, [ ] push / pop,
+    & ^ pitch down / up, \\ / roll counterclockwise / clockwise.
+    Other symbols draw nothing unless mapped """
+    def __init__(self, axiom="", rules=None, depth=0, angle=90, step=10):
+        self.axiom = axiom
+        self.rules = rules if rules is not None else {}  # Symbol -> successor
+        self.depth = depth
+        self.angle = angle
+        self.step = step
+        self.mapping = {}  # Symbol -> commands replacing its default ones
+
+    def load(self, lines):
+        """ Read directives, one per line, with comments after #:
+        axiom F--F--F, rule F F+F--F+F, depth 4, angle 60, step 5, map X forward 5; left 30 """
+        for i_line, line in enumerate(lines, 1):
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            directive, args = words[0], words[1:]
+            if directive == "axiom":
+                self.axiom = "".join(args)
+            elif directive == "rule" and args and len(args[0]) == 1:
+                self.rules[args[0]] = "".join(args[1:])
+            elif directive == "depth" and len(args) == 1 and args[0].isdigit():
+                self.depth = int(args[0])
+            elif directive in ("angle", "step") and len(args) == 1 and pattern_number.match(args[0]):
+                setattr(self, directive, float(args[0]) if "." in args[0] else int(args[0]))
+            elif directive == "map" and args and len(args[0]) == 1:
+                commands = []
+                for words_command in " ".join(args[1:]).split(";"):
+                    if words_command.split():
+                        command = Command(words_command.split())
+                        command.line = i_line
+                        command.column = 1
+                        commands.append(command)
+                self.mapping[args[0]] = commands
+            else:
+                raise SyntaxError(f"Invalid L-system directive at line {i_line}: {line.strip()}")
+
+    def commands(self, symbol):
+        """ Commands drawn for a symbol that is not rewritten any further """
+        if symbol in self.mapping:
+            return self.mapping[symbol]
+        angle, step = str(self.angle), str(self.step)
+        defaults = {
+            "F": [("forward", step)],
+            "G": [("forward", step)],
+            "f": [("penup",), ("forward", step), ("pendown",)],
+            "+": [("left", angle)],
+            "-": [("right", angle)],
+            "|": [("left", "180")],
+            "[": [("push",)],
+            "]": [("pop",)],
+            "&": [("down", angle)],
+            "^": [("up", angle)],
+            "\\": [("roll_ccw", angle)],
+            "/": [("roll_cw", angle)],
+        }
+        return defaults.get(symbol, [])
 
 
 class Interpreter:
     def __init__(self):
         self.variables = {}  # Global variables
-        self.commands = []   # Commands
+        self.source = None   # Generator of the top-level commands not parsed yet
+        self.cache_key = None  # Key to cache the program with once it is parsed
+        self.parse_complete = False  # The source was parsed to its end without error
+        self.num_steps = 0     # Steps executed since the start of the program
+        self.interval_keyframes = 1000  # Steps between keyframes
+        self.max_keyframes = 256        # Every other keyframe is dropped and the interval doubled beyond this
+        self.clear_keyframes()
+        self.code = []       # Compiled program (flat list of (opcode, operand))
         self.pc = 0          # Program counter
-        self.context_stack = []  # State management stack for repeat blocks
+        self.loop_counts = []      # Repeat count of each loop slot
+        self.loop_iterations = []  # Current iteration of each loop slot
+        self.call_stack = []       # Return pc of each subroutine being executed
+
+        # Dispatch table indexed by opcode
+        self.dispatch = [
+            self.op_set,
+            self.op_penup,
+            self.op_pendown,
+            self.op_forward,
+            self.op_right,
+            self.op_left,
+            self.op_add,
+            self.op_loop,
+            self.op_next,
+            self.op_reset,
+            self.op_up,
+            self.op_down,
+            self.op_roll_cw,
+            self.op_roll_ccw,
+            self.op_spawn,
+            self.op_call,
+            self.op_return,
+            self.op_push,
+            self.op_pop,
+            self.op_unknown,
+        ]
+        self.dispatch_plain = self.dispatch
+        self.undo_log = None  # Ring buffer of (pc, loop slot, variable, turtle snapshot, call stack) before each step
+        self.set_profiling(False)
 
     def set_variable(self, name, value):
         self.variables[name] = int(value)
-        print(f"Set variable {name} = {value}")
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, f"Set variable {name} = {value}")
 
     def get_variable(self, name):
         if name not in self.variables:
             raise NameError(f"Variable '{name}' is not defined")
         return self.variables[name]
 
-    def get_value(self, value):
-        """Determine if the input is a variable name or a literal number and return its value."""
+    def operand(self, value):
+        """Pre-resolve an argument: a literal number becomes int or float, a variable name stays str."""
         if value.isdigit():
-            return int(value)  # Return the integer if it's a number
-        elif value in self.variables:
-            return self.get_variable(value)  # Return the value of the variable
+            return int(value)
+        if pattern_number.match(value):
+            return float(value) if "." in value else int(value)
+        return value
+
+    def resolve(self, operand):
+        """Return the value of a pre-resolved operand."""
+        if operand.__class__ is not str:
+            return operand
+        try:
+            return self.variables[operand]
+        except KeyError:
+            raise ValueError(f"Invalid value or undefined variable: '{operand}'") from None
+
+    def compile_next(self):
+        """ Parse and compile the next top-level command, return False at the end of the source """
+        try:
+            command = next(self.source, None) if self.source is not None else None
+            if command is not None:
+                self.compile_commands([command])
+                return True
+        except Exception:
+            # The rest of the program is lost, it must not be cached
+            self.source = None
+            self.cache_key = None
+            raise
+        if self.parse_complete and self.cache_key is not None:
+            program_cache.put(self.cache_key, self.compiled())
+        self.source = None
+        self.cache_key = None
+        return False
+
+    def compile_commands(self, commands):
+        """ Append top-level commands to the program """
+        num_loops = self.compile_block(commands, self.code, len(self.loop_counts))
+        self.loop_counts.extend([0] * (num_loops - len(self.loop_counts)))
+        self.loop_iterations.extend([0] * (num_loops - len(self.loop_iterations)))
+
+    def compile_block(self, commands, code, num_loops):
+        """ Append the instructions of a block to code and return the number of loop slots in use """
+        for command, *args in commands:
+            if command == "repeat":
+                slot = num_loops
+                num_loops += 1
+                i_loop = len(code)
+                code.append(None)  # Patched once the end of the block is known
+                num_loops = self.compile_block(args[1], code, num_loops)
+                code.append((OP_NEXT, (slot, i_loop + 1)))
+                code[i_loop] = (OP_LOOP, (slot, self.operand(args[0]), len(code)))
+            elif command == "set":
+                code.append((OP_SET, (args[0], args[1])))
+            elif command == "add":
+                code.append((OP_ADD, (args[0], self.operand(args[1]))))
+            elif command == "spawn":
+                code.append((OP_SPAWN, (self.operand(args[0]), self.operand(args[1]) if len(args) > 1 else 360)))
+            elif command in opcodes:
+                code.append((opcodes[command], self.operand(args[0]) if args else None))
+            else:
+                code.append((OP_UNKNOWN, command))
+        return num_loops
+
+    def load_lsystem(self, lsystem):
+        """ Compile an L-system without expanding its string: the axiom is the main program and the successor
+        of a symbol at each generation is a subroutine, called by the generation before it.
+        The code grows with depth times the size of the rules and the call stack with depth """
+        self.source = None
+        self.cache_key = None
+        self.code = []
+        subroutines = {}  # (symbol, generation) -> pc
+        calls = []        # Calls to patch: (pc of the call, symbol, generation)
+        self.code.append((OP_PENDOWN, None))  # The pen of a new turtle is up
+        num_loops = self.compile_symbols(lsystem, lsystem.axiom, 0, calls, 0)
+        self.code.append((OP_RETURN, None))
+        while calls:
+            pc, symbol, generation = calls.pop()
+            if (symbol, generation) not in subroutines:
+                subroutines[(symbol, generation)] = len(self.code)
+                num_loops = self.compile_symbols(lsystem, lsystem.rules[symbol], generation, calls, num_loops)
+                self.code.append((OP_RETURN, None))
+            self.code[pc] = (OP_CALL, subroutines[(symbol, generation)])
+        self.loop_counts = [0] * num_loops
+        self.loop_iterations = [0] * num_loops
+        self.profile_blocks = {}
+
+    def compile_symbols(self, lsystem, symbols, generation, calls, num_loops):
+        """ Append the commands of the symbols of a generation, a call for each symbol rewritten further """
+        for symbol in symbols:
+            if symbol in lsystem.rules and generation < lsystem.depth:
+                calls.append((len(self.code), symbol, generation + 1))
+                self.code.append(None)  # Patched once the subroutine is compiled
+            else:
+                num_loops = self.compile_block(lsystem.commands(symbol), self.code, num_loops)
+        return num_loops
+
+    def op_set(self, operand):
+        name, value = operand
+        self.set_variable(name, value)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"set {name} {value}")
+
+    def op_penup(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "penup")
+        my_turtle.penup()
+
+    def op_pendown(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "pendown")
+        my_turtle.pendown()
+
+    def op_forward(self, operand):
+        steps = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"forward {steps}")
+        my_turtle.forward_step(steps)
+
+    def op_right(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"right {angle}")
+        my_turtle.right(angle)
+
+    def op_left(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"left {angle}")
+        my_turtle.left(angle)
+
+    def op_add(self, operand):
+        var_name, increment = operand
+        increment = self.resolve(increment)
+        self.variables[var_name] += increment
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"add {var_name} {increment}")
+
+    def op_loop(self, operand):
+        slot, count, end_pc = operand
+        count = self.resolve(count)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"repeat {count}")
+        if count > 0:
+            self.loop_counts[slot] = count
+            self.loop_iterations[slot] = 0
         else:
-            raise ValueError(f"Invalid value or undefined variable: '{value}'")
-
-    def execute_command(self, command, *args):
-        """ Execute commands """
-        if command == "set":
-            self.set_variable(args[0], args[1])
-            print(f"set {args[0]} {args[1]}")
-        elif command == "penup":
-            print(f"penup")
-            my_turtle.penup()
-        elif command == "pendown":
-            print(f"pendown")
-            my_turtle.pendown()
-        elif command == "forward":
-            steps = self.get_value(args[0])
-            print(f"forward {steps}")
-            my_turtle.forward_step(steps)
-        elif command == "right":
-            angle = self.get_value(args[0])
-            print(f"right {angle}")
-            my_turtle.right(angle)
-        elif command == "left":
-            angle = self.get_value(args[0])
-            print(f"left {angle}")
-            my_turtle.left(angle)
-        elif command == "up":
-            angle = self.get_value(args[0])
-            print(f"up {angle}")
-            my_turtle.up(angle)
-        elif command == "down":
-            angle = self.get_value(args[0])
-            print(f"down {angle}")
-            my_turtle.down(angle)
-        elif command == "roll_cw":
-            angle = self.get_value(args[0])
-            print(f"roll_cw {angle}")
-            my_turtle.roll_cw(angle)
-        elif command == "roll_ccw":
-            angle = self.get_value(args[0])
-            print(f"roll_ccw {angle}")
-            my_turtle.roll_ccw(angle)
-        elif command == "add":
-            var_name = args[0]
-            increment = self.get_value(args[1])
-            self.variables[var_name] += increment
-            print(f"add {var_name} {increment}")
-        elif command == "repeat":
-            count = self.get_value(args[0])
-            block_commands = args[1]
-            self.context_stack.append({
-                "commands": block_commands,
-                "count": count,
-                "iteration": 0,
-                "index": 0
-            })
-            print(f"repeat {count}")
-        elif command == "reset":
-            print(f"reset")
-            my_turtle.reset()
+            self.pc = end_pc
+
+    def op_next(self, operand):
+        slot, body_pc = operand
+        self.loop_iterations[slot] += 1
+        if self.loop_iterations[slot] < self.loop_counts[slot]:
+            # Continue repeat block
+            self.pc = body_pc
+            if trace.level >= TRACE_DEBUG:
+                trace.write(TRACE_DEBUG, f"Repeat iteration {self.loop_iterations[slot]} of {self.loop_counts[slot]}")
         else:
-            print(f"Unknown command: {command}")
+            # Finish repeat block
+            if trace.level >= TRACE_DEBUG:
+                trace.write(TRACE_DEBUG, "End repeat block")
+
+    def op_reset(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "reset")
+        my_turtle.reset()
+
+    def op_up(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"up {angle}")
+        my_turtle.up(angle)
+
+    def op_down(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"down {angle}")
+        my_turtle.down(angle)
+
+    def op_roll_cw(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"roll_cw {angle}")
+        my_turtle.roll_cw(angle)
+
+    def op_roll_ccw(self, operand):
+        angle = self.resolve(operand)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"roll_ccw {angle}")
+        my_turtle.roll_ccw(angle)
+
+    def op_spawn(self, operand):
+        count, spread = operand
+        count, spread = self.resolve(count), self.resolve(spread)
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, f"spawn {count} {spread}")
+        my_turtle.spawn(count, spread)
+
+    def op_push(self, operand):
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "push")
+        my_turtle.push()
+
+    def op_pop(self, operand):
+        if my_turtle.depth_stack == 0:
+            if trace.level >= TRACE_SUMMARY:
+                trace.write(TRACE_SUMMARY, "Pop with an empty stack")
+            return
+        if trace.level >= TRACE_COMMAND:
+            trace.write(TRACE_COMMAND, "pop")
+        my_turtle.pop()
+
+    def op_call(self, operand):
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, f"Call {operand}")
+        self.call_stack.append(self.pc)
+        self.pc = operand
+
+    def op_return(self, operand):
+        if trace.level >= TRACE_DEBUG:
+            trace.write(TRACE_DEBUG, "Return")
+        self.pc = self.call_stack.pop() if self.call_stack else len(self.code)
+
+    def op_unknown(self, operand):
+        if trace.level >= TRACE_SUMMARY:
+            trace.write(TRACE_SUMMARY, f"Unknown command: {operand}")
 
     def step(self):
-        if self.context_stack:
-            # Process the current context
-            current_context = self.context_stack[-1]
-            commands = current_context["commands"]
-            index = current_context["index"]
-            iteration = current_context["iteration"]
-            count = current_context["count"]
-
-            if index < len(commands):
-                # Execute commands in current block
-                command, *args = commands[index]
-                self.execute_command(command, *args)
-                current_context["index"] += 1
+        pc = self.pc
+        if pc < len(self.code) or self.compile_next():
+            if self.num_steps == self.step_keyframe:
+                self.save_keyframe()
+            # Fetch and dispatch one instruction
+            op, operand = self.code[pc]
+            self.pc = pc + 1
+            self.dispatch[op](operand)
+            self.num_steps += 1
+            return True  # Continue program
+        if trace.level >= TRACE_SUMMARY:
+            trace.write(TRACE_SUMMARY, "Program finished")
+        return False  # Finish program
+
+    def run(self, max_steps, time_budget=None, op_stop=None):
+        """ Execute up to max_steps steps or until time_budget (sec) is spent or the next instruction is op_stop,
+        return the number of executed steps and whether the program continues """
+        deadline = time.perf_counter() + time_budget if time_budget else None
+        num_steps = 0
+        while num_steps < max_steps:
+            if op_stop is not None and self.next_op() == op_stop:
+                break
+            if not self.step():
+                return num_steps, False
+            num_steps += 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+        return num_steps, True
+
+    def next_op(self):
+        """ Opcode of the next instruction, None at the end of the program """
+        if self.pc < len(self.code) or self.compile_next():
+            return self.code[self.pc][0]
+        return None
+
+    def clear_keyframes(self):
+        self.keyframes = []       # (step, pc, loop counts, loop iterations, variables, turtle snapshot)
+        self.steps_keyframes = []  # Step of each keyframe, ascending
+        self.spacing_keyframes = self.interval_keyframes
+        self.step_keyframe = 0    # Step to save the next keyframe at
+
+    def save_keyframe(self):
+        """ Snapshot the state before step num_steps is executed """
+        num_steps = self.num_steps
+        self.step_keyframe = num_steps + self.spacing_keyframes
+        if self.steps_keyframes and num_steps <= self.steps_keyframes[-1]:
+            return  # Replaying steps after a seek
+        self.keyframes.append((num_steps, self.pc, list(self.loop_counts), list(self.loop_iterations),
+                               dict(self.variables), my_turtle.snapshot(), tuple(self.call_stack)))
+        self.steps_keyframes.append(num_steps)
+        if len(self.keyframes) > self.max_keyframes:
+            self.keyframes = self.keyframes[::2]
+            self.steps_keyframes = self.steps_keyframes[::2]
+            self.spacing_keyframes *= 2
+
+    def seek(self, num_steps):
+        """ Go to the state after num_steps steps, replaying only the steps after the nearest keyframe.
+        Return the number of steps reached and whether the program continues """
+        i = bisect.bisect_right(self.steps_keyframes, num_steps) - 1
+        if i >= 0 and not self.steps_keyframes[i] <= self.num_steps <= num_steps:
+            step, self.pc, loop_counts, loop_iterations, variables, turtle, call_stack = self.keyframes[i]
+            self.call_stack = list(call_stack)
+            self.num_steps = step
+            self.step_keyframe = step
+            self.loop_counts[:len(loop_counts)] = loop_counts
+            self.loop_iterations[:len(loop_iterations)] = loop_iterations
+            self.variables = dict(variables)
+            my_turtle.restore(turtle)
+            if self.undo_log is not None:
+                self.undo_log.clear()
+        while self.num_steps < num_steps:
+            if not self.step():
+                return self.num_steps, False
+        return self.num_steps, True
+
+    def set_profiling(self, is_profiling, pre_hook=None, post_hook=None):
+        """ Count calls and time of each opcode and iterations of each repeat block.
+        When off, the dispatch table holds the plain handlers and nothing is measured.
+        pre_hook(interpreter, pc, op, operand) and post_hook(interpreter, pc, op, operand, ns) run around each command """
+        self.is_profiling = is_profiling
+        self.pre_hook = pre_hook
+        self.post_hook = post_hook
+        self.profile_calls = [0] * len(self.dispatch_plain)
+        self.profile_ns = [0] * len(self.dispatch_plain)
+        self.profile_blocks = {}    # pc of repeat -> [entries, iterations]
+        self.profile_sections = {}  # Section of a frame -> [calls, ns]
+        self.build_dispatch()
+
+    def build_dispatch(self):
+        """ Wrap the plain handlers for the undo log and profiling, as enabled """
+        dispatch = self.dispatch_plain
+        if self.undo_log is not None:
+            dispatch = [self.recorded(op, handler) for op, handler in enumerate(dispatch)]
+        if self.is_profiling:
+            dispatch = [self.profiled(op, handler) for op, handler in enumerate(dispatch)]
+        self.dispatch = dispatch
+
+    def set_undo(self, num_steps):
+        """ Keep what the last num_steps steps changed to step back, 0 disables it """
+        self.undo_log = deque(maxlen=num_steps) if num_steps > 0 else None
+        self.build_dispatch()
+
+    def recorded(self, op, handler):
+        """ Handler of op that first pushes the state it changes to the undo log """
+        undo_log = self.undo_log
+        if op in (OP_LOOP, OP_NEXT):
+            def handler_recorded(operand):
+                slot = operand[0]
+                undo_log.append((self.pc - 1, (slot, self.loop_counts[slot], self.loop_iterations[slot]), None, None, None))
+                handler(operand)
+        elif op == OP_SET or op == OP_ADD:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, (operand[0], self.variables.get(operand[0])), None, None))
+                handler(operand)
+        elif op == OP_CALL or op == OP_RETURN:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, None, None, tuple(self.call_stack)))
+                handler(operand)
+        else:
+            def handler_recorded(operand):
+                undo_log.append((self.pc - 1, None, None, my_turtle.snapshot(), None))
+                handler(operand)
+        return handler_recorded
+
+    def step_back(self):
+        """ Undo the last step, from the undo log or else from a keyframe. Return False at the start """
+        if not self.undo_log:
+            if self.num_steps == 0:
+                return False
+            self.seek(self.num_steps - 1)
+            return True
+        self.pc, loop, variable, turtle, call_stack = self.undo_log.pop()
+        if loop is not None:
+            slot, self.loop_counts[slot], self.loop_iterations[slot] = loop
+        if variable is not None:
+            name, value = variable
+            if value is None:
+                del self.variables[name]
             else:
-                # Continue repeat block
-                current_context["iteration"] += 1
-                if current_context["iteration"] < count:
-                    current_context["index"] = 0
-                    print(f"Repeat iteration {current_context['iteration']} of {count}")
+                self.variables[name] = value
+        if turtle is not None:
+            my_turtle.restore(turtle)
+        if call_stack is not None:
+            self.call_stack = list(call_stack)
+        self.num_steps -= 1
+        return True
+
+    def profiled(self, op, handler):
+        """ Handler of op wrapped with counters and hooks """
+        def handler_profiled(operand):
+            pc = self.pc - 1
+            if self.pre_hook is not None:
+                self.pre_hook(self, pc, op, operand)
+            time_start = time.perf_counter_ns()
+            handler(operand)
+            ns = time.perf_counter_ns() - time_start
+            self.profile_calls[op] += 1
+            self.profile_ns[op] += ns
+            if op == OP_LOOP:
+                self.profile_blocks.setdefault(pc, [0, 0])[0] += 1
+            elif op == OP_NEXT:
+                self.profile_blocks.setdefault(operand[1] - 1, [0, 0])[1] += 1
+            if self.post_hook is not None:
+                self.post_hook(self, pc, op, operand, ns)
+        return handler_profiled
+
+    def profile_section(self, name, ns):
+        """ Add the time of a section outside the interpreter, e.g. update_draw or canvas draw """
+        section = self.profile_sections.setdefault(name, [0, 0])
+        section[0] += 1
+        section[1] += ns
+
+    def profile_report(self):
+        lines = ["Opcode          calls    total ms    ns/call"]
+        for op in sorted(range(len(self.profile_calls)), key=lambda op: -self.profile_ns[op]):
+            calls, ns = self.profile_calls[op], self.profile_ns[op]
+            if calls:
+                lines.append(f"{opcode_names[op]:14s} {calls:6d} {ns / 1e6:11.3f} {ns / calls:10.0f}")
+        if self.profile_blocks:
+            lines.append("Repeat block    entries  iterations")
+            for pc, (entries, iterations) in sorted(self.profile_blocks.items()):
+                lines.append(f"pc {pc:<11d} {entries:8d} {iterations:11d}")
+        if self.profile_sections:
+            lines.append("Section         calls    total ms    ns/call")
+            for name, (calls, ns) in self.profile_sections.items():
+                lines.append(f"{name:14s} {calls:6d} {ns / 1e6:11.3f} {ns / calls:10.0f}")
+        return "\n".join(lines)
+
+    def parse(self, lines):
+        """ Yield the top-level commands of an iterable of lines, each one at the end of its last line.
+        A line holds several commands, each one taking the number of arguments in arities,
+        and an unknown one the words up to the next known command """
+        blocks = []  # Open repeat blocks: (count, commands, line, column)
+        for i_line, line in enumerate(lines, 1):
+            if "[" not in line and "]" not in line and "#" not in line:
+                words = line.split()
+                if not words:
+                    continue
+                if len(words) - 1 <= arities.get(words[0], (0, -1))[1]:
+                    # Fast path: one command
+                    if words[0] == "repeat":
+                        raise SyntaxError(f"Repeat block must start with '[' at line {i_line}")
+                    command = Command(words)
+                    command.line = i_line
+                    command.column = len(line) - len(line.lstrip()) + 1
+                    if blocks:
+                        blocks[-1][1].append(command)
+                    else:
+                        yield command
+                    continue
+
+            words = []
+            columns = []
+            for match in pattern_token.finditer(line):
+                token = match.group()
+                if token[0] == "#":
+                    break
+                if token == "[":
+                    commands = self.split_words(words, columns)
+                    if not commands or commands[-1][0][0] != "repeat" or len(commands[-1][0]) != 2:
+                        raise SyntaxError(f"Unexpected '[' at line {i_line}, column {match.start() + 1}")
+                    for command in self.parse_commands(commands[:-1], i_line, blocks):
+                        yield command
+                    (_, count), column = commands[-1]
+                    blocks.append((count, [], i_line, column))
+                    words = []
+                    columns = []
+                elif token == "]":
+                    for command in self.parse_commands(self.split_words(words, columns), i_line, blocks):
+                        yield command
+                    words = []
+                    columns = []
+                    if not blocks:
+                        raise SyntaxError(f"Unexpected ']' at line {i_line}, column {match.start() + 1}")
+                    count, block, line_repeat, column_repeat = blocks.pop()
+                    for command in self.parse_words(["repeat", count, block], line_repeat, column_repeat, blocks):
+                        yield command
                 else:
-                    # Finish repeat block
-                    self.context_stack.pop()
-                    print("End repeat block")
-        elif self.pc < len(self.commands):
-            # Execute global commands
-            command, *args = self.commands[self.pc]
-            self.pc += 1
-            self.execute_command(command, *args)
-        else:
-            print("Program finished")
-            return False  # Finish program
-        return True  # Continue program
-
-    def parse_block(self, lines, start_index):
-        """ parse repeat block """
+                    words.append(token)
+                    columns.append(match.start() + 1)
+            for command in self.parse_commands(self.split_words(words, columns), i_line, blocks):
+                yield command
+        if blocks:
+            raise SyntaxError(f"No closing ']' found for the repeat block at line {blocks[-1][2]}, column {blocks[-1][3]}")
+        self.parse_complete = True
+
+    def split_words(self, words, columns):
+        """ Split the words of a line into the words of each command, return a list of (words, column) """
         commands = []
-        i = start_index
-        while i < len(lines):
-            line = lines[i].strip()
-            if line == "]":
-                return commands, i
-            parts = line.split()
-            command = parts[0]
-            if command == "repeat":
-                block_var = parts[1]
-                if parts[2] != "[":
-                    raise SyntaxError("Repeat block must start with '['")
-                nested_commands, new_index = self.parse_block(lines, i + 1)
-                commands.append((command, block_var, nested_commands))
-                i = new_index
-            else:
-                commands.append((command, *parts[1:]))
-            i += 1
-        raise SyntaxError("No closing ']' found for a repeat block")
-
-    def load_program(self, lines):
         i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if not line or line.startswith("#"):
-                i += 1
-                continue
+        while i < len(words):
+            min_args, max_args = arities.get(words[i], (0, len(words)))
+            end = min(i + 1 + min_args, len(words))
+            while end < min(i + 1 + max_args, len(words)) and words[end] not in arities:
+                end += 1
+            commands.append((words[i:end], columns[i]))
+            i = end
+        return commands
+
+    def parse_commands(self, commands, line, blocks):
+        """ Add the commands split from a line, a repeat needs its '[' on the same line """
+        for words, column in commands:
+            if words[0] == "repeat":
+                raise SyntaxError(f"Repeat block must start with '[' at line {line}, column {column}")
+            for command in self.parse_words(words, line, column, blocks):
+                yield command
+
+    def parse_words(self, words, line, column, blocks):
+        """ Add a command to the innermost open block, or yield it at the top level """
+        command = Command(words)
+        command.line = line
+        command.column = column
+        if blocks:
+            blocks[-1][1].append(command)
+        else:
+            yield command
+
+    def stream_program(self, lines, cache_key=None):
+        """ Start a program from an iterable of lines (a file, a generator, ...),
+        the top-level commands are parsed and compiled as execution reaches them.
+        With cache_key, the compiled program goes to program_cache at the end of the source """
+        self.source = self.parse(lines)
+        self.cache_key = cache_key
+        self.parse_complete = False
+        self.profile_blocks = {}
+
+    def compiled(self):
+        """ Program to cache: (code, number of loop slots), the commands are only kept in the operands that need them """
+        return list(self.code), len(self.loop_counts)
+
+    def load_compiled(self, program):
+        code, num_loops = program
+        self.code = list(code)
+        self.loop_counts = [0] * num_loops
+        self.loop_iterations = [0] * num_loops
+        self.source = None
+        self.cache_key = None
+        self.profile_blocks = {}
 
-            parts = line.split()
-            command = parts[0]
-            if command == "repeat":
-                block_var = parts[1]
-                if parts[2] != "[":
-                    raise SyntaxError("Repeat block must start with '['")
-                block_commands, new_index = self.parse_block(lines, i + 1)
-                self.commands.append((command, block_var, block_commands))
-                i = new_index
-            else:
-                self.commands.append((command, *parts[1:]))
-            i += 1
+    def load_program(self, lines):
+        """ Parse and compile a whole program """
+        self.profile_blocks = {}
+        self.compile_commands(list(self.parse(lines)))
 
     def reset(self):
         self.pc = 0
-        self.context_stack = []
+        self.num_steps = 0
+        self.call_stack = []
+        self.clear_keyframes()
+        if self.undo_log is not None:
+            self.undo_log.clear()
+        self.loop_counts = [0] * len(self.loop_counts)
+        self.loop_iterations = [0] * len(self.loop_iterations)
 
     def clear(self):
         self.pc = 0
-        self.context_stack = []
-        self.commands = []
+        self.num_steps = 0
+        self.call_stack = []
+        self.clear_keyframes()
+        if self.undo_log is not None:
+            self.undo_log.clear()
+        self.source = None
+        self.cache_key = None
+        self.code = []
+        self.loop_counts = []
+        self.loop_iterations = []
+
+
+class Engine:
+    """ Run the interpreter on a worker thread, one frame of steps at a time.
+    The turtle events of each frame go to the Tk thread through a bounded queue,
+    the worker waits while it is full instead of running ahead of the view """
+    def __init__(self, interpreter, turtle, view, max_frames=8):
+        self.interpreter = interpreter
+        self.turtle = turtle
+        self.view = view
+        self.frames = queue.Queue(maxsize=max_frames)  # (turtle events, steps, steps since the start, is_run, error)
+        self.lock = threading.Lock()  # Held while the interpreter and the turtle are used
+        self.is_play = threading.Event()  # The worker runs frames while set
+        self.is_run = True  # The program continues as of the last frame, no frames after its end
+        self.max_steps = 1
+        self.time_budget = None
+        view.events = deque()  # The turtle's queue belongs to the worker, the view gets the events of taken frames
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            self.is_play.wait()
+            with self.lock:
+                if not self.is_play.is_set() or not self.is_run:
+                    self.is_play.clear()
+                    continue
+                num_steps_start = self.interpreter.num_steps
+                error = None
+                try:
+                    num_steps, self.is_run = self.interpreter.run(self.max_steps, self.time_budget)
+                except Exception as e:
+                    # Ends the program, not the worker, the error goes to the Tk thread with the frame
+                    num_steps, self.is_run = self.interpreter.num_steps - num_steps_start, False
+                    error = e
+                events, self.turtle.events = self.turtle.events, deque()
+                trace.flush()
+                # Waits while the Tk thread is behind, it drains the queue before taking the lock
+                self.frames.put((events, num_steps, self.interpreter.num_steps, self.is_run, error))
+
+    def next_frame(self):
+        """ Hand the events of the next frame to the view, return (steps, steps since the start, is_run)
+        or None if the worker has not finished one. An error of the program is reported here """
+        try:
+            events, num_steps, num_steps_total, is_run, error = self.frames.get_nowait()
+        except queue.Empty:
+            return None
+        self.view.events.extend(events)
+        if error is not None:
+            print(f"Error while running program: {error}")
+        return num_steps, num_steps_total, is_run
+
+    def drain(self):
+        """ Hand the events of all queued frames to the view, return their number of steps """
+        num_steps = 0
+        frame = self.next_frame()
+        while frame is not None:
+            num_steps += frame[0]
+            frame = self.next_frame()
+        return num_steps
+
+    def acquire(self):
+        """ Pause the worker and take the interpreter for a command of the Tk thread,
+        return the number of steps of the frames the worker had queued """
+        self.is_play.clear()
+        num_steps = 0
+        while not self.lock.acquire(timeout=0.005):
+            num_steps += self.drain()  # Lets a worker waiting to put a frame finish it
+        return num_steps + self.drain()
+
+    def release(self):
+        """ Hand the events of the Tk thread's command to the view and give the interpreter back """
+        self.view.events.extend(self.turtle.events)
+        self.turtle.events.clear()
+        self.is_run = True
+        trace.flush()
+        self.lock.release()
+
+
+def create_window():
+    """ Embed in Tkinter, imported here so that rendering without GUI works where Tk is not installed """
+    global root, canvas, toolbar, tk, ttk
+    import tkinter as tk
+    from tkinter import ttk
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    root = tk.Tk()
+    root.title(title_tk)
+    canvas = FigureCanvasTkAgg(fig, root)
+    canvas.get_tk_widget().pack(expand=True, fill="both")
+
+    toolbar = NavigationToolbar2Tk(canvas, root)
+    canvas.get_tk_widget().pack()
+
+
+def render_file(filename, output, is_profiling=False):
+    """ Run a command file to the end without Tkinter and save the final figure """
+    global canvas, interpreter, my_turtle, my_turtle_view
+    canvas = FigureCanvasAgg(fig)
+    interpreter = Interpreter()
+    interpreter.set_profiling(is_profiling)
+    my_turtle = Turtle3d(xyz=np.array([0., 0., 0.]), direction=0.)
+    my_turtle_view = Turtle3dView(ax=ax0, turtle=my_turtle, size=size_turtle, color="green")
+
+    time_start = time.perf_counter_ns()
+    load_file(filename)
+    is_running = True
+    while is_running:
+        _, is_running = interpreter.run(10000)
+        my_turtle_view.consume_events()
+    time_run = time.perf_counter_ns()
+
+    my_turtle_view.finish_segment()
+    my_turtle_view.update_draw()
+    time_update_draw = time.perf_counter_ns()
+    fig.savefig(output)
+    trace.flush()
+    if is_profiling:
+        interpreter.profile_section("run", time_run - time_start)
+        interpreter.profile_section("update_draw", time_update_draw - time_run)
+        interpreter.profile_section("savefig", time.perf_counter_ns() - time_update_draw)
+        print(interpreter.profile_report())
+
+
+def load_file(filename):
+    """ Load a command file into the interpreter, parsing it only if its content is not in program_cache.
+    An .lsys file is an L-system, compiled into subroutines """
+    if os.path.splitext(filename)[1] == ".lsys":
+        lsystem = LSystem()
+        with open(filename) as f:
+            lsystem.load(f)
+        interpreter.load_lsystem(lsystem)
+        return
+    with open(filename, "rb") as f:
+        key = program_cache.key(f)
+    program = program_cache.get(key)
+    if program is not None:
+        interpreter.load_compiled(program)
+    else:
+        interpreter.stream_program(read_lines(filename), cache_key=key)
+
+
+def read_lines(filename):
+    """ Lines of a text file, which stays open only until the last one is read """
+    with open(filename) as f:
+        yield from f
 
 
 def execute_file(filename):
-    global is_run, is_play
-    interpreter.clear()
+    global is_run, is_play, is_fast_forward
+    is_fast_forward = False
+    acquire_interpreter()
     try:
-        with open(filename) as f:
-            lines = f.readlines()
+        interpreter.clear()
+        my_turtle.forget_path()  # The keyframes are cleared
+        load_file(filename)
     except FileNotFoundError:
-        pass
         print(f"Error: File '{filename}' not found.")
+        return
     except Exception as e:
         print(f"Error while processing file: {e}")
+        return
+    finally:
+        release_interpreter()
 
-    interpreter.load_program(lines)
     is_play = True
     is_run = True
 
@@ -473,10 +1674,53 @@ def create_animation_control():
     frm_anim.pack(side="left", fill=tk.Y)
     btn_play = tk.Button(frm_anim, text="Play/Pause", command=switch)
     btn_play.pack(side="left")
+    btn_back = tk.Button(frm_anim, text="Step back", command=step_back)
+    btn_back.pack(side="left")
+    btn_end = tk.Button(frm_anim, text="Run to end", command=run_to_end)
+    btn_end.pack(side="left")
+    btn_next_reset = tk.Button(frm_anim, text="Run to reset", command=lambda: run_to_end(OP_RESET))
+    btn_next_reset.pack(side="left")
     btn_reset = tk.Button(frm_anim, text="Reset", command=reset)
     btn_reset.pack(side="left")
 
 
+def create_speed_control():
+    global var_steps, var_budget
+    frm_speed = ttk.Labelframe(root, relief="ridge", text="Speed", labelanchor="n")
+    frm_speed.pack(side="left", fill=tk.Y)
+
+    lbl_steps = tk.Label(frm_speed, text="Steps/frame:")
+    lbl_steps.pack(side="left")
+    var_steps = tk.StringVar(root)
+    var_steps.set(str(steps_per_frame))
+    spn_steps = tk.Spinbox(
+        frm_speed, textvariable=var_steps, format="%.0f", from_=1, to=100000, increment=1, width=6,
+        command=set_speed
+    )
+    spn_steps.bind("<Return>", lambda event: set_speed())
+    spn_steps.pack(side="left")
+
+    lbl_budget = tk.Label(frm_speed, text="ms/frame (0: off):")
+    lbl_budget.pack(side="left")
+    var_budget = tk.StringVar(root)
+    var_budget.set(str(budget_ms_per_frame))
+    spn_budget = tk.Spinbox(
+        frm_speed, textvariable=var_budget, format="%.0f", from_=0, to=1000, increment=10, width=5,
+        command=set_speed
+    )
+    spn_budget.bind("<Return>", lambda event: set_speed())
+    spn_budget.pack(side="left")
+
+
+def set_speed():
+    global steps_per_frame, budget_ms_per_frame
+    try:
+        steps_per_frame = max(1, int(float(var_steps.get())))
+        budget_ms_per_frame = max(0., float(var_budget.get()))
+    except ValueError:
+        pass
+
+
 def create_file_name_setter():
     frm_fn = ttk.Labelframe(root, relief="ridge", text="File name", labelanchor="n")
     frm_fn.pack(side='left')
@@ -486,19 +1730,28 @@ def create_file_name_setter():
     btn_run.pack(side='left')
 
 
+def manual_command(command, *args):
+    """ Run a turtle command of the manual control, taking the turtle from the engine's worker thread if any """
+    acquire_interpreter()
+    try:
+        command(*args)
+    finally:
+        release_interpreter()
+
+
 def create_manual_control():
     frm_man = ttk.Labelframe(root, relief="ridge", text="Manual control", labelanchor="n")
     frm_man.pack(side='left')
 
-    btn_pu = tk.Button(frm_man, text="penup", command=lambda: my_turtle.penup())
+    btn_pu = tk.Button(frm_man, text="penup", command=lambda: manual_command(my_turtle.penup))
     btn_pu.pack(side='left')
 
-    btn_pd = tk.Button(frm_man, text="pendown", command=lambda: my_turtle.pendown())
+    btn_pd = tk.Button(frm_man, text="pendown", command=lambda: manual_command(my_turtle.pendown))
     btn_pd.pack(side='left')
 
     var_fd = tk.StringVar(root)
     var_fd.set(str(1))
-    btn_fd = tk.Button(frm_man, text="forward", command=lambda: my_turtle.forward(float(var_fd.get())))
+    btn_fd = tk.Button(frm_man, text="forward", command=lambda: manual_command(my_turtle.forward, float(var_fd.get())))
     btn_fd.pack(side='left')
     spn_fd = tk.Spinbox(
         frm_man, textvariable=var_fd, format="%.0f", from_=1, to=100, increment=1, width=4
@@ -507,7 +1760,7 @@ def create_manual_control():
 
     var_rt = tk.StringVar(root)
     var_rt.set(str(1))
-    btn_rt = tk.Button(frm_man, text="right", command=lambda: my_turtle.right(float(var_rt.get())))
+    btn_rt = tk.Button(frm_man, text="right", command=lambda: manual_command(my_turtle.right, float(var_rt.get())))
     btn_rt.pack(side='left')
     spn_rt = tk.Spinbox(
         frm_man, textvariable=var_rt, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -516,7 +1769,7 @@ def create_manual_control():
 
     var_lt = tk.StringVar(root)
     var_lt.set(str(1))
-    btn_lt = tk.Button(frm_man, text="left", command=lambda: my_turtle.left(float(var_lt.get())))
+    btn_lt = tk.Button(frm_man, text="left", command=lambda: manual_command(my_turtle.left, float(var_lt.get())))
     btn_lt.pack(side='left')
     spn_lt = tk.Spinbox(
         frm_man, textvariable=var_lt, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -525,7 +1778,7 @@ def create_manual_control():
 
     var_up = tk.StringVar(root)
     var_up.set(str(1))
-    btn_up = tk.Button(frm_man, text="up", command=lambda: my_turtle.up(float(var_up.get())))
+    btn_up = tk.Button(frm_man, text="up", command=lambda: manual_command(my_turtle.up, float(var_up.get())))
     btn_up.pack(side='left')
     spn_up = tk.Spinbox(
         frm_man, textvariable=var_up, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -534,7 +1787,7 @@ def create_manual_control():
 
     var_dn = tk.StringVar(root)
     var_dn.set(str(1))
-    btn_dn = tk.Button(frm_man, text="down", command=lambda: my_turtle.down(float(var_dn.get())))
+    btn_dn = tk.Button(frm_man, text="down", command=lambda: manual_command(my_turtle.down, float(var_dn.get())))
     btn_dn.pack(side='left')
     spn_dn = tk.Spinbox(
         frm_man, textvariable=var_dn, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -543,7 +1796,7 @@ def create_manual_control():
 
     var_cw = tk.StringVar(root)
     var_cw.set(str(1))
-    btn_cw = tk.Button(frm_man, text="roll_cw", command=lambda: my_turtle.roll_cw(float(var_cw.get())))
+    btn_cw = tk.Button(frm_man, text="roll_cw", command=lambda: manual_command(my_turtle.roll_cw, float(var_cw.get())))
     btn_cw.pack(side='left')
     spn_cw = tk.Spinbox(
         frm_man, textvariable=var_cw, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -552,7 +1805,7 @@ def create_manual_control():
 
     var_ccw = tk.StringVar(root)
     var_ccw.set(str(1))
-    btn_ccw = tk.Button(frm_man, text="roll_ccw", command=lambda: my_turtle.roll_ccw(float(var_ccw.get())))
+    btn_ccw = tk.Button(frm_man, text="roll_ccw", command=lambda: manual_command(my_turtle.roll_ccw, float(var_ccw.get())))
     btn_ccw.pack(side='left')
     spn_ccw = tk.Spinbox(
         frm_man, textvariable=var_ccw, format="%.0f", from_=1, to=360, increment=1, width=4
@@ -561,39 +1814,218 @@ def create_manual_control():
 
 
 def reset():
-    global is_play, is_run
+    global is_play, is_run, is_fast_forward
+    is_fast_forward = False
     is_play = False
     is_run = False
+    acquire_interpreter()
     interpreter.reset()
     cnt.reset()
     my_turtle.reset()
+    my_turtle.forget_path()  # The keyframes are cleared
+    release_interpreter()
+
+
+def create_seek_control():
+    global scl_seek
+    frm_seek = ttk.Labelframe(root, relief="ridge", text="Seek", labelanchor="n")
+    frm_seek.pack(side="left", fill=tk.Y)
+    scl_seek = tk.Scale(frm_seek, orient="horizontal", from_=0, to=0, length=160)
+    scl_seek.bind("<ButtonRelease-1>", lambda event: seek(scl_seek.get()))
+    scl_seek.pack(side="left")
+
+
+def seek(num_steps):
+    global is_run, is_fast_forward
+    is_fast_forward = False
+    acquire_interpreter()
+    try:
+        num_steps, is_run = interpreter.seek(num_steps)
+    except Exception as e:
+        print(f"Error while running program: {e}")
+        num_steps, is_run = interpreter.num_steps, False
+    finally:
+        release_interpreter()
+    cnt.reset()
+    cnt.count_up(num_steps)
+
+
+def step_back():
+    global is_play, is_run, is_fast_forward
+    is_fast_forward = False
+    is_play = False
+    acquire_interpreter()
+    if interpreter.step_back():
+        is_run = True
+        cnt.reset()
+        cnt.count_up(interpreter.num_steps)
+        scl_seek.set(interpreter.num_steps)
+    release_interpreter()
 
 
 def switch():
-    global is_play
+    global is_play, is_fast_forward
+    is_fast_forward = False
     is_play = not is_play
 
 
-def update(f):
-    global is_run
-    if not is_play:
+def run_to_end(op_stop=None):
+    """ Run the program without drawing frames, then draw once.
+    With op_stop (OP_RESET), stop before the next instruction with this opcode instead of the end """
+    global is_fast_forward, is_run
+    if is_fast_forward or not is_run:
         return
+    acquire_interpreter()
+    if op_stop is not None and interpreter.next_op() == op_stop:
+        num_steps, is_run = run_program(1)  # Pass the one the last run stopped at
+        cnt.count_up(num_steps)
+    release_interpreter()
     if not is_run:
         return
-    cnt.count_up()
-    if not interpreter.step():
-        is_run = False
+    is_fast_forward = True
+    root.after_idle(run_chunk, op_stop)
+
+
+def run_chunk(op_stop):
+    """ One chunk of run_to_end, the next one is scheduled after Tkinter has handled its events """
+    global is_fast_forward, is_run, is_play
+    if not is_fast_forward:
+        return  # Cancelled
+    acquire_interpreter()
+    num_steps, is_run = run_program(steps_fast_forward, op_stop=op_stop)
+    release_interpreter()
+    cnt.count_up(num_steps)
+    my_turtle_view.consume_events()  # Keep the event queue short, the path is drawn once at the end
+    trace.flush()
+    if is_run and num_steps == steps_fast_forward:
+        root.after(1, run_chunk, op_stop)
+        return
+    is_fast_forward = False
+    is_play = False
+    if interpreter.num_steps > scl_seek.cget("to"):
+        scl_seek.configure(to=interpreter.num_steps)
+    scl_seek.set(interpreter.num_steps)
+    my_turtle_view.finish_segment()
+    my_turtle_view.update_draw()
+    blit_manager.background = None  # Draw everything in one full redraw instead of a blitted stroke
+    canvas.draw_idle()
+
+
+def run_program(max_steps, time_budget=None, op_stop=None):
+    """ Interpreter.run for the Tk thread: the file is parsed as it runs,
+    an error in it is reported and ends the program instead of the timer callback """
+    num_steps_start = interpreter.num_steps
+    try:
+        return interpreter.run(max_steps, time_budget, op_stop)
+    except Exception as e:
+        print(f"Error while running program: {e}")
+        return interpreter.num_steps - num_steps_start, False
+
+
+def acquire_interpreter():
+    """ Take the interpreter from the worker thread of the engine, if any, for a command of the Tk thread """
+    if engine is not None:
+        cnt.count_up(engine.acquire())
+
+
+def release_interpreter():
+    if engine is not None:
+        engine.release()
+
+
+def max_steps_frame():
+    """ Step cap of a frame: steps_per_frame, or none when a ms budget decides how much runs """
+    return steps_per_frame if budget_ms_per_frame == 0 else sys.maxsize
+
+
+def update_engine():
+    """ Take one frame of steps from the engine, whose worker runs ahead while playing """
+    global is_run
+    engine.max_steps = max_steps_frame()
+    engine.time_budget = budget_ms_per_frame / 1000.
+    if not (is_play and is_run):
+        engine.is_play.clear()
+        return
+    engine.is_play.set()
+    frame = engine.next_frame() if not my_turtle_view.is_moving() else None
+    if frame is not None:
+        num_steps, num_steps_total, is_run = frame
+        cnt.count_up(num_steps)
+        if num_steps_total > scl_seek.cget("to"):
+            scl_seek.configure(to=num_steps_total)
+        scl_seek.set(num_steps_total)
 
 
-""" main loop """
-if __name__ == "__main__":
-    create_animation_control()
-    create_file_name_setter()
-    create_manual_control()
-    cnt = Counter(ax=ax0, is3d=True, xy=np.array([x_min, y_max]), z=z_max, label="Step=")
+def update():
+    global is_run
+    if is_fast_forward:
+        return
+    time_start = time.perf_counter_ns()
+    if engine is not None:
+        update_engine()
+    elif is_play and is_run and not my_turtle_view.is_moving():
+        num_steps, is_run = run_program(max_steps_frame(), budget_ms_per_frame / 1000.)
+        cnt.count_up(num_steps)
+        if interpreter.num_steps > scl_seek.cget("to"):
+            scl_seek.configure(to=interpreter.num_steps)
+        scl_seek.set(interpreter.num_steps)
+    time_run = time.perf_counter_ns()
+    my_turtle_view.update_draw()
+    time_update_draw = time.perf_counter_ns()
+    blit_manager.update()
+    if engine is None:
+        trace.flush()  # The worker flushes its own trace
+    if interpreter.is_profiling:
+        interpreter.profile_section("run", time_run - time_start)
+        interpreter.profile_section("update_draw", time_update_draw - time_run)
+        interpreter.profile_section("blit", time.perf_counter_ns() - time_update_draw)
 
-    interpreter = Interpreter()
-    my_turtle = Turtle3d(ax=ax0, xyz=np.array([0., 0., 0.]), direction=0., size=size_turtle, color="green")
 
-    anim = animation.FuncAnimation(fig, update, interval=100, save_count=100)
-    root.mainloop()
\ No newline at end of file
+""" main loop """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=title_tk)
+    parser.add_argument("--render", metavar="FILE", help="run a command file to the end without GUI and save the figure")
+    parser.add_argument("-o", "--output", help="output image file (.png, .svg, ...), default: FILE with .png")
+    parser.add_argument("--trace", choices=["off", "summary", "command", "debug"], default="command", help="trace level of executed commands")
+    parser.add_argument("--cache-dir", metavar="DIR", help="also keep compiled programs in this directory")
+    parser.add_argument("--keyframe-interval", type=int, default=1000, metavar="K", help="steps between keyframes for seeking")
+    parser.add_argument("--max-keyframes", type=int, default=256, metavar="N", help="max number of keyframes, the interval doubles beyond it")
+    parser.add_argument("--undo-steps", type=int, default=10000, metavar="N", help="steps kept to step back in O(1), older ones go through keyframes")
+    parser.add_argument("--profile", action="store_true", help="print calls and time of each command, repeat block and frame section")
+    parser.add_argument("--trace-sample", type=int, default=1, metavar="N", help="trace every N-th command")
+    parser.add_argument("--thread", action="store_true", help="run the interpreter on a worker thread, the timer only draws")
+    args = parser.parse_args()
+    trace.level = ["off", "summary", "command", "debug"].index(args.trace)
+    trace.sample = args.trace_sample
+    program_cache.directory = args.cache_dir
+
+    if args.render:
+        render_file(args.render, args.output or os.path.splitext(args.render)[0] + ".png", args.profile)
+    else:
+        create_window()
+        create_animation_control()
+        create_speed_control()
+        create_seek_control()
+        create_file_name_setter()
+        create_manual_control()
+        cnt = Counter(ax=ax0, is3d=True, xy=np.array([x_min, y_max]), z=z_max, label="Step=")
+
+        interpreter = Interpreter()
+        interpreter.set_profiling(args.profile)
+        interpreter.interval_keyframes = args.keyframe_interval
+        interpreter.max_keyframes = args.max_keyframes
+        interpreter.clear_keyframes()
+        interpreter.set_undo(args.undo_steps)
+        my_turtle = Turtle3d(xyz=np.array([0., 0., 0.]), direction=0.)
+        my_turtle_view = Turtle3dView(ax=ax0, turtle=my_turtle, size=size_turtle, color="green")
+        if args.thread:
+            engine = Engine(interpreter, my_turtle, my_turtle_view)
+
+        blit_manager = BlitManager(canvas, artists=[cnt.txt_step], views=[my_turtle_view])
+        timer = canvas.new_timer(interval=100)
+        timer.add_callback(update)
+        timer.start()
+        root.mainloop()
+        trace.flush()
+        if args.profile:
+            print(interpreter.profile_report())